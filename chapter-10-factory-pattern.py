@@ -1,3 +1,10 @@
+import numpy as np
+import copy as cp
+import asyncio
+import ast
+import numbers
+import scipy.stats as stats
+
 # 1. the problem
 
 ## conversion routine to go from strings, strikes to pay-offs. 
@@ -52,7 +59,7 @@ class PayOffCall(PayOff):
         return self._strike
 
     def __call__(self, spot):
-        return max(self._strike - spot, 0)
+        return np.maximum(self._strike - spot, 0)
 
 
 class VanillaOption:
@@ -97,3 +104,391 @@ if call_payoff != None:
     print(f'the payoff is {call_payoff(3)}')
 
     del call_payoff
+
+# 7. a pricing service - micro-batching requests over the factory
+
+# quoting one trade at a time pays the whole set-up cost of a simulation for
+# every request
+# PricingService resolves each request through the factory, then parks it for
+# a short window - every request for the same engine and underlying that
+# arrives inside the window is priced in one vectorised batch
+# callers await a future and never see the batching
+# the batch runs in the default executor so the event loop keeps accepting
+# requests while it computes
+
+# the "mc" engine prices a batch of European options on one underlying from a
+# single set of draws - terminal spots form a (paths x trades) matrix
+
+
+def mc_batch_price(options, spot, vol, r, paths):
+    expiries = np.array([option.get_expiry() for option in options], dtype=float)
+    variates = np.random.normal(size=(paths, 1))
+
+    variance = vol * vol * expiries
+    moved_spots = spot * np.exp(r * expiries - 0.5 * variance)
+    these_spots = moved_spots * np.exp(np.sqrt(variance) * variates)
+    discounting = np.exp(-r * expiries)
+
+    prices = np.zeros(len(options))
+    for j in range(len(options)):
+        prices[j] = discounting[j] * np.mean(options[j](these_spots[:, j]))
+
+    return prices
+
+
+class PricingService:
+    def __init__(self, factory, window=0.002, paths=100000):
+        self._factory = factory
+        self._window = window
+        self._paths = paths
+        self._pending = {}
+        self._flushes = set()
+        self._engines = {"mc": mc_batch_price}
+
+    def register_engine(self, engine_id, batch_function):
+        self._engines[engine_id] = batch_function
+
+    async def price(self, payoff_id, strike, expiry, spot, vol, r, engine="mc"):
+        if engine not in self._engines.keys():
+            raise ValueError(f'{engine} is unknown!')
+
+        payoff = self._factory.create_payoff(payoff_id, strike)
+        if payoff is None:
+            raise ValueError(f'{payoff_id} is unknown!')
+
+        key = (engine, spot, vol, r)
+        future = asyncio.get_running_loop().create_future()
+
+        if key not in self._pending.keys():
+            self._pending[key] = []
+            ## the event loop only keeps a weak reference to a task
+            flush = asyncio.ensure_future(self.flush(key))
+            self._flushes.add(flush)
+            flush.add_done_callback(self._flushes.discard)
+
+        self._pending[key].append((VanillaOption(expiry, payoff), future))
+        return await future
+
+    async def flush(self, key):
+        await asyncio.sleep(self._window)
+        batch = self._pending.pop(key)
+        engine, spot, vol, r = key
+        options = [option for option, future in batch]
+
+        try:
+            prices = await asyncio.get_running_loop().run_in_executor(
+                None, self._engines[engine], options, spot, vol, r, self._paths)
+        except Exception as error:
+            for option, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        for (option, future), price in zip(batch, prices):
+            if not future.done():
+                future.set_result(price)
+
+
+async def quote_book(service):
+    requests = [("call", strike, 1.0, spot, 0.2, 0.05) for spot in (100, 50) for strike in range(40, 121, 10)]
+    return await asyncio.gather(*(service.price(*request) for request in requests))
+
+
+service = PricingService(payoff_factory)
+quotes = asyncio.run(quote_book(service))
+
+print(f'{len(quotes)} quotes priced, first = {quotes[0]}')
+
+# 8. payoff expressions - new payoffs without new classes
+
+## every new payoff so far has been a PayOff subclass with a scalar __call__
+## registered through a PayOffHelper
+## a payoff can instead be written as an expression in S (the spot) and K (the
+## strike) - "max(S - K, 0)", "S > K", "max(S - K1, 0) - max(S - K2, 0)"
+## with a tuple of strikes K1, K2, ... (K is K1)
+## S may hold several fixings along its last axis - mean(S), gmean(S), max(S)
+## and min(S) reduce over them, while max(a, b) and min(a, b) are elementwise
+## the reductions need S with a fixings axis (paths x fixings) - on a vector of
+## terminal spots, as the vanilla engines pass, they raise rather than average
+## over the paths
+## the expression is parsed once, checked against a small whitelist and
+## compiled into a vectorised numpy function, cached by its text
+
+def over_fixings(reduction):
+    def reduce(x):
+        if np.ndim(x) < 2:
+            raise ValueError("this payoff reduces over fixings - it needs spots of shape (paths x fixings)!")
+        return reduction(x)
+    return reduce
+
+
+expression_functions = {
+    "exp": np.exp,
+    "log": np.log,
+    "sqrt": np.sqrt,
+    "abs": np.abs,
+    "mean": over_fixings(lambda x: np.mean(x, axis=-1)),
+    "gmean": over_fixings(lambda x: np.exp(np.mean(np.log(x), axis=-1))),
+    "max": lambda *x: over_fixings(lambda y: np.max(y, axis=-1))(x[0]) if len(x) == 1 else np.maximum(*x),
+    "min": lambda *x: over_fixings(lambda y: np.min(y, axis=-1))(x[0]) if len(x) == 1 else np.minimum(*x),
+}
+
+expression_nodes = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call, ast.Name, ast.Load,
+                    ast.Constant, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd,
+                    ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.BitAnd, ast.BitOr)
+
+
+class ChainedComparisons(ast.NodeTransformer):
+    ## a < S < b is (a < S) & (S < b) - python's own "and" does not work on arrays
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        terms = [node.left] + node.comparators
+        pairs = [ast.Compare(left=terms[i], ops=[node.ops[i]], comparators=[terms[i + 1]]) for i in range(len(node.ops))]
+
+        result = pairs[0]
+        for pair in pairs[1:]:
+            result = ast.BinOp(left=result, op=ast.BitAnd(), right=pair)
+
+        return result
+
+
+compiled_payoffs = {}
+
+
+def compile_payoff(expression):
+    if expression in compiled_payoffs.keys():
+        return compiled_payoffs[expression]
+
+    tree = ast.parse(expression, mode="eval")
+
+    for node in ast.walk(tree):
+        if not isinstance(node, expression_nodes):
+            raise ValueError(f'{type(node).__name__} is not allowed in a payoff expression!')
+        if isinstance(node, ast.Call) and (not isinstance(node.func, ast.Name) or node.func.id not in expression_functions.keys()):
+            raise ValueError(f'unknown function in payoff expression {expression}!')
+        if isinstance(node, ast.Name) and node.id not in expression_functions.keys() and node.id != "S" and not node.id.startswith("K"):
+            raise ValueError(f'unknown name {node.id} in payoff expression!')
+
+    tree = ast.fix_missing_locations(ChainedComparisons().visit(tree))
+    code = compile(tree, "<payoff>", "eval")
+
+    def function(spot, strikes):
+        names = dict(expression_functions)
+        names["S"] = spot
+        names.update(strikes)
+        return np.asarray(eval(code, {"__builtins__": {}}, names), dtype=float)
+
+    compiled_payoffs[expression] = function
+    return function
+
+
+class PayOffExpression(PayOff):
+    def __init__(self, expression, strike):
+        self._strike = strike
+        self._expression = expression
+        self._function = compile_payoff(expression)
+
+        if isinstance(strike, (tuple, list)):
+            self._strikes = {f'K{i + 1}': strike[i] for i in range(len(strike))}
+            self._strikes["K"] = strike[0]
+        else:
+            self._strikes = {"K": strike, "K1": strike}
+
+    def get_strike(self):
+        return self._strike
+
+    def get_expression(self):
+        return self._expression
+
+    def __call__(self, spot):
+        return self._function(np.asarray(spot, dtype=float), self._strikes)
+
+
+class PayOffExpressionHelper:
+    def __init__(self, payoff_id, expression):
+        self._expression = expression
+        compile_payoff(expression)
+        payoff_factory.register_payoff(payoff_id, self.create)
+
+    def create(self, strike):
+        return PayOffExpression(self._expression, strike)
+
+
+register_vanilla = PayOffExpressionHelper("vanilla_call", "max(S - K, 0)")
+register_digital = PayOffExpressionHelper("digital", "S > K")
+register_spread = PayOffExpressionHelper("call_spread", "max(S - K1, 0) - max(S - K2, 0)")
+register_corridor = PayOffExpressionHelper("corridor", "K1 <= S <= K2")
+register_asian = PayOffExpressionHelper("asian_call", "max(mean(S) - K, 0)")
+
+spots = np.array([80.0, 100.0, 120.0])
+fixings = np.array([[90.0, 100.0, 110.0], [100.0, 110.0, 120.0]])
+
+print(f'vanilla call = {payoff_factory.create_payoff("vanilla_call", 100)(spots)}')
+print(f'call spread = {payoff_factory.create_payoff("call_spread", (90, 110))(spots)}')
+print(f'corridor = {payoff_factory.create_payoff("corridor", (90, 110))(spots)}')
+print(f'asian call = {payoff_factory.create_payoff("asian_call", 100)(fixings)}')
+
+# 9. routing to closed forms - simulation only when it is needed
+
+## a European vanilla or digital under constant vol and rate, and a geometric
+## Asian on discrete fixings, all have Black-Scholes closed forms - pricing them
+## by simulation or a 400-step tree costs time and adds noise
+## PricingRouter looks at the product, its payoff and the parameter types and
+## uses a registered analytic pricer when one applies, otherwise the requested
+## numerical engine ("mc" or "tree")
+## analytic pricers are registered by product class and payoff - the payoff
+## class, or the expression text for a PayOffExpression - so new closed forms
+## plug in the same way payoffs do
+## vol and r must be plain numbers for a closed form; numerical=True skips the
+## closed forms altogether, to validate them against the engines
+## PayOffCall pays max(K - S, 0) in these notes, so its closed form is the
+## Black-Scholes put
+
+class AsianOption:
+    def __init__(self, fixing_times, payoff):
+        self._fixing_times = np.asarray(fixing_times, dtype=float)
+        self._payoff = payoff
+
+    def get_expiry(self):
+        return self._fixing_times[-1]
+
+    def get_fixing_times(self):
+        return self._fixing_times
+
+    def get_payoff(self):
+        return self._payoff
+
+    def __call__(self, spots):
+        return self._payoff(spots)
+
+
+def bs_d1_d2(spot, strike, vol, r, expiry):
+    std_dev = vol * np.sqrt(expiry)
+    d1 = (np.log(spot / strike) + (r + 0.5 * vol * vol) * expiry) / std_dev
+    return d1, d1 - std_dev
+
+
+def analytic_call(option, spot, vol, r):
+    strike, expiry = option.get_payoff().get_strike(), option.get_expiry()
+    d1, d2 = bs_d1_d2(spot, strike, vol, r, expiry)
+    return spot * stats.norm.cdf(d1) - strike * np.exp(-r * expiry) * stats.norm.cdf(d2)
+
+
+def analytic_put(option, spot, vol, r):
+    strike, expiry = option.get_payoff().get_strike(), option.get_expiry()
+    d1, d2 = bs_d1_d2(spot, strike, vol, r, expiry)
+    return strike * np.exp(-r * expiry) * stats.norm.cdf(-d2) - spot * stats.norm.cdf(-d1)
+
+
+def analytic_digital(option, spot, vol, r):
+    strike, expiry = option.get_payoff().get_strike(), option.get_expiry()
+    d1, d2 = bs_d1_d2(spot, strike, vol, r, expiry)
+    return np.exp(-r * expiry) * stats.norm.cdf(d2)
+
+
+def analytic_geometric_asian(option, spot, vol, r):
+    ## log of the geometric mean is Gaussian - its variance sums min(t_i, t_j)
+    strike, times = option.get_payoff().get_strike(), option.get_fixing_times()
+    mean = np.log(spot) + (r - 0.5 * vol * vol) * np.mean(times)
+    variance = vol * vol * np.sum(np.minimum.outer(times, times)) / len(times) ** 2
+    d1 = (mean - np.log(strike) + variance) / np.sqrt(variance)
+    d2 = d1 - np.sqrt(variance)
+
+    return np.exp(-r * option.get_expiry()) * (np.exp(mean + 0.5 * variance) * stats.norm.cdf(d1) - strike * stats.norm.cdf(d2))
+
+
+def mc_price(option, spot, vol, r, paths=100000):
+    if isinstance(option, VanillaOption):
+        return mc_batch_price([option], spot, vol, r, paths)[0]
+
+    times = option.get_fixing_times()
+    steps = np.diff(times, prepend=0.0)
+    log_spots = np.log(spot) + np.cumsum((r - 0.5 * vol * vol) * steps
+                                         + vol * np.sqrt(steps) * np.random.normal(size=(paths, len(times))), axis=1)
+
+    return np.exp(-r * option.get_expiry()) * np.mean(option(np.exp(log_spots)))
+
+
+def tree_price(option, spot, vol, r, steps=400):
+    if not isinstance(option, VanillaOption):
+        raise ValueError("the tree only prices European options!")
+
+    dt = option.get_expiry() / steps
+    up = np.exp(vol * np.sqrt(dt))
+    probability = (np.exp(r * dt) - 1 / up) / (up - 1 / up)
+    values = option(spot * up ** np.arange(-steps, steps + 1, 2, dtype=float))
+
+    for i in range(steps):
+        values = np.exp(-r * dt) * (probability * values[1:] + (1 - probability) * values[:-1])
+
+    return values[0]
+
+
+def analytic_key(option):
+    payoff = option.get_payoff()
+
+    if isinstance(payoff, PayOffExpression):
+        return (type(option), payoff.get_expression())
+
+    return (type(option), type(payoff))
+
+
+class PricingRouter:
+    def __init__(self):
+        self._analytic = {}
+        self._engines = {"mc": mc_price, "tree": tree_price}
+
+    def register_analytic(self, option_type, payoff_type, pricer):
+        self._analytic[(option_type, payoff_type)] = pricer
+
+    def register_engine(self, engine_id, pricer):
+        self._engines[engine_id] = pricer
+
+    def route(self, option, vol, r, engine="mc", numerical=False):
+        constant = isinstance(vol, numbers.Real) and isinstance(r, numbers.Real)
+
+        if not numerical and constant and analytic_key(option) in self._analytic.keys():
+            return "analytic"
+
+        if engine not in self._engines.keys():
+            raise ValueError(f'{engine} is unknown!')
+
+        return engine
+
+    def price(self, option, spot, vol, r, engine="mc", numerical=False):
+        route = self.route(option, vol, r, engine, numerical)
+
+        if route == "analytic":
+            return self._analytic[analytic_key(option)](option, spot, vol, r)
+
+        return self._engines[route](option, spot, vol, r)
+
+
+register_geometric_asian = PayOffExpressionHelper("geometric_asian_call", "max(gmean(S) - K, 0)")
+
+router = PricingRouter()
+router.register_analytic(VanillaOption, PayOffCall, analytic_put)
+router.register_analytic(VanillaOption, "max(S - K, 0)", analytic_call)
+router.register_analytic(VanillaOption, "S > K", analytic_digital)
+router.register_analytic(AsianOption, "max(gmean(S) - K, 0)", analytic_geometric_asian)
+
+monthly = np.arange(1, 13) / 12
+book = [("call (K - S)+", VanillaOption(1.0, payoff_factory.create_payoff("call", 110)), "tree"),
+        ("vanilla call", VanillaOption(1.0, payoff_factory.create_payoff("vanilla_call", 110)), "tree"),
+        ("digital", VanillaOption(1.0, payoff_factory.create_payoff("digital", 110)), "mc"),
+        ("geometric asian", AsianOption(monthly, payoff_factory.create_payoff("geometric_asian_call", 100)), "mc"),
+        ("arithmetic asian", AsianOption(monthly, payoff_factory.create_payoff("asian_call", 100)), "mc")]
+
+np.random.seed(0)
+for name, option, engine in book:
+    price = router.price(option, 100, 0.2, 0.05, engine)
+    check = router.price(option, 100, 0.2, 0.05, engine, numerical=True)
+
+    print(f'{name}: {router.route(option, 0.2, 0.05, engine)} = {price}, {engine} = {check}')
+
+## a payoff on fixings cannot be priced as a vanilla on terminal spots
+
+try:
+    router.price(VanillaOption(1.0, payoff_factory.create_payoff("asian_call", 100)), 100, 0.2, 0.05)
+except ValueError as error:
+    print(f'asian_call as a vanilla: {error}')
@@ -1,5 +1,13 @@
 import numpy as np
 import copy as cp
+import functools
+import hashlib
+import os
+import pickle
+import types
+import time
+from collections import OrderedDict
+import scipy.stats as stats
 
 class ParametersInner:
     def __init__(self):
@@ -153,7 +161,8 @@ class mc_mean(mc_statistics):
 # 3. using the statistics gatherer
 
 ## define a new mc function with gatherer check
-def simple_mc_main_5(option, spot, parameters, paths, stats_gather):
+def simple_mc_main_5(option, spot, parameters, paths, stats_gather, strata=None, shift=None, budget=None,
+                     moment_matching=False):
 
     # define required variables
     vol = Parameters(parameters[0])
@@ -165,6 +174,24 @@ def simple_mc_main_5(option, spot, parameters, paths, stats_gather):
     moved_spot = spot * np.exp(r.integral(0, expiry) + ito_correct)
     discounting = np.exp(-r.integral(0, expiry))
 
+    if moment_matching and (strata is not None or shift is not None or budget is not None):
+        raise ValueError("moment matching cannot be combined with strata, a shift or a time budget!")
+
+    if budget is not None and (strata is not None or shift is not None):
+        raise ValueError("a time budget cannot be combined with strata or a shift!")
+
+    if budget is not None:
+        return deadline_mc(option, moved_spot, std_dev, discounting, paths, stats_gather, budget)
+
+    if shift is not None:
+        return importance_mc(option, moved_spot, std_dev, discounting, paths, stats_gather, strata, shift)
+
+    if strata is not None:
+        return stratified_mc(option, moved_spot, std_dev, discounting, paths, stats_gather, strata)
+
+    if moment_matching:
+        return moment_matched_mc(option, moved_spot, std_dev, discounting, paths, stats_gather)
+
     for i in range(paths):
         this_spot = moved_spot * np.exp(std_dev * np.random.normal(0, 1, 1))
         stats_gather.dump_one_result(discounting * option.calculate_payoff(this_spot))
@@ -236,3 +263,500 @@ for i in range(len(results)):
 # 6. decorations
 
 ## add functionality to a class without changing its interface - decorator
+
+# 7. memoising prices - a cache in front of the pricer
+
+## identical pricing calls are recomputed from scratch every time
+## a price is fully determined by the product, the market inputs and the
+## simulation settings (paths, seed) - hash all three canonically and the
+## second call becomes a lookup
+## canonical_key walks objects through their attributes, so two separately
+## built but equal options hash the same
+## a function hashes by its module, qualified name, code (with its constants),
+## defaults and the contents of its closure, a method also by its object and
+## a functools.partial by its function, arguments and keywords - so closures,
+## lambdas and partials of the same code with different values get different
+## keys
+## module globals a function reads are not part of its key - a pricer that
+## depends on one should take it as an argument
+## entries are evicted least-recently-used, by count and by pickled size
+## prices tagged with an underlying are dropped when that underlying's market
+## changes - other underlyings keep theirs - and the cache can be saved to and
+## reloaded from disk
+
+def canonical_form(item):
+    if isinstance(item, np.ndarray):
+        return ("ndarray", str(item.dtype), item.shape, item.tobytes())
+    if isinstance(item, (list, tuple)):
+        return (type(item).__name__, tuple(canonical_form(i) for i in item))
+    if isinstance(item, dict):
+        return ("dict", tuple(sorted((repr(k), canonical_form(v)) for k, v in item.items())))
+    if isinstance(item, (set, frozenset)):
+        return (type(item).__name__, tuple(sorted(repr(canonical_form(i)) for i in item)))
+    if isinstance(item, (np.generic, float, int, complex, str, bytes, bool, type(None))):
+        return (type(item).__name__, repr(item))
+    if isinstance(item, types.CodeType):
+        return ("code", item.co_code, canonical_form(item.co_consts), item.co_names)
+    if isinstance(item, functools.partial):
+        return ("partial", canonical_form(item.func), canonical_form(item.args), canonical_form(item.keywords))
+    if isinstance(item, types.MethodType):
+        return ("method", canonical_form(item.__func__), canonical_form(item.__self__))
+    if isinstance(item, types.FunctionType):
+        try:
+            cells = tuple(cell.cell_contents for cell in item.__closure__ or ())
+        except ValueError:
+            raise TypeError(f"cannot hash {item.__qualname__} canonically - its closure is not filled in!")
+
+        return ("function", item.__module__, item.__qualname__, canonical_form(item.__code__),
+                canonical_form(item.__defaults__), canonical_form(item.__kwdefaults__), canonical_form(cells))
+    if isinstance(item, types.BuiltinFunctionType):
+        if item.__self__ is not None and not isinstance(item.__self__, types.ModuleType):
+            return ("builtin method", item.__qualname__, canonical_form(item.__self__))
+        return ("builtin", item.__module__, item.__qualname__)
+    if callable(item) and not hasattr(item, "__dict__"):
+        return ("callable", getattr(item, "__qualname__", repr(item)))
+    if hasattr(item, "__dict__"):
+        return (type(item).__qualname__, canonical_form(vars(item)))
+
+    raise TypeError(f"cannot hash {type(item).__name__} canonically!")
+
+
+def canonical_key(item):
+    return hashlib.sha256(repr(canonical_form(item)).encode()).hexdigest()
+
+
+class PriceCache:
+    def __init__(self, max_entries=1024, max_bytes=None, path=None):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._path = path
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._markets = {}
+
+        if path is not None and os.path.exists(path):
+            with open(path, "rb") as cache_file:
+                self._markets, entries = pickle.load(cache_file)
+            for key, value, underlying in entries:
+                self.put(key, value, underlying)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        if key not in self._entries.keys():
+            return None
+
+        self._entries.move_to_end(key)
+        return self._entries[key][0]
+
+    def put(self, key, value, underlying=None):
+        if key in self._entries.keys():
+            self._bytes -= self._entries.pop(key)[1]
+
+        size = len(pickle.dumps(value))
+        self._entries[key] = (value, size, underlying)
+        self._bytes += size
+
+        while len(self._entries) > self._max_entries or (self._max_bytes is not None and self._bytes > self._max_bytes):
+            self._bytes -= self._entries.popitem(last=False)[1][1]
+
+    def update_market(self, underlying, market):
+        market_key = canonical_key(market)
+
+        if underlying in self._markets.keys() and self._markets[underlying] != market_key:
+            for key in [key for key, entry in self._entries.items() if entry[2] == underlying]:
+                self._bytes -= self._entries.pop(key)[1]
+
+        self._markets[underlying] = market_key
+
+    def clear(self):
+        self._entries.clear()
+        self._markets.clear()
+        self._bytes = 0
+
+    def price(self, function, product, market, settings, underlying=None):
+        ## the market is part of the key, so untagged prices are never stale -
+        ## old ones just age out
+        if underlying is not None:
+            self.update_market(underlying, market)
+
+        key = canonical_key((function, product, market, settings))
+        value = self.get(key)
+
+        if value is None:
+            value = function(product, *market, *settings)
+            self.put(key, value, underlying)
+
+        return value
+
+    def save(self):
+        if self._path is None:
+            raise ValueError("no path to save the price cache to!")
+
+        with open(self._path, "wb") as cache_file:
+            pickle.dump((self._markets, [(key, entry[0], entry[2]) for key, entry in self._entries.items()]), cache_file)
+
+
+## the pricer behind the cache has to be a pure function of its inputs, so the
+## seed is one of the settings
+
+def priced_mc_main_5(option, spot, parameters, paths, seed):
+    np.random.seed(seed)
+    gatherer = mc_mean()
+    simple_mc_main_5(option, spot, parameters, paths, gatherer)
+    return gatherer.get_results_so_far()[0][0]
+
+
+def priced_vectorised_mc_5(option, spot, parameters, paths, seed):
+    vol, r = parameters
+    expiry = option.get_expiry()
+    variates = np.random.default_rng(seed).standard_normal(paths)
+    these_spots = spot * np.exp((r - 0.5 * vol * vol) * expiry + vol * np.sqrt(expiry) * variates)
+    return np.exp(-r * expiry) * np.mean([option.calculate_payoff(this_spot) for this_spot in these_spots])
+
+
+cache = PriceCache(max_entries=256)
+
+first = cache.price(priced_mc_main_5, VanillaOption(1, PayOffCall(7)), (5, [0.3, 0.05]), (10000, 42))
+second = cache.price(priced_mc_main_5, VanillaOption(1, PayOffCall(7)), (5, [0.3, 0.05]), (10000, 42))
+moved = cache.price(priced_mc_main_5, VanillaOption(1, PayOffCall(7)), (5.1, [0.3, 0.05]), (10000, 42))
+
+print(first, second, moved, len(cache))
+
+## two different pricers on the same inputs are two entries
+
+other = cache.price(priced_vectorised_mc_5, VanillaOption(1, PayOffCall(7)), (5, [0.3, 0.05]), (10000, 42))
+
+if other == first or len(cache) != 3:
+    raise RuntimeError("two pricers share a cache entry!")
+
+print(f'mc_main_5 = {first}, vectorised = {other}')
+
+## closures and partials of one function differ by the values they carry
+
+def make_scaled_pricer(scale):
+    def scaled_pricer(option, spot, parameters, paths, seed):
+        return scale * option.calculate_payoff(spot)
+    return scaled_pricer
+
+def scaled_payoff(option, spot, parameters, paths, seed, scale=1.0):
+    return scale * option.calculate_payoff(spot)
+
+pricers = [make_scaled_pricer(1.0), make_scaled_pricer(2.0),
+           functools.partial(scaled_payoff, scale=1.0), functools.partial(scaled_payoff, scale=2.0)]
+prices = [cache.price(pricer, VanillaOption(1, PayOffCall(7)), (2, [0.3, 0.05]), (1, 0)) for pricer in pricers]
+
+if prices != [5.0, 10.0, 5.0, 10.0]:
+    raise RuntimeError("closures or partials share a cache entry!")
+
+print(f'closures and partials = {prices}')
+
+## alternating underlyings keep their prices; a new market for "abc" only
+## drops the prices of "abc"
+
+cache = PriceCache(max_entries=256)
+
+for underlying, spot in (("abc", 5), ("xyz", 50), ("abc", 5), ("xyz", 50)):
+    cache.price(priced_mc_main_5, VanillaOption(1, PayOffCall(7)), (spot, [0.3, 0.05]), (1000, 42), underlying=underlying)
+
+cache.price(priced_mc_main_5, VanillaOption(1, PayOffCall(7)), (5.1, [0.3, 0.05]), (1000, 42), underlying="abc")
+
+print(f'{len(cache)} entries after two underlyings and one market move')
+
+# 8. stratified sampling of the terminal spot
+
+## a European payoff only sees the terminal Gaussian, so its one dimension can
+## be stratified - split (0, 1) into equal-probability strata, draw a uniform
+## inside each and map it through the inverse normal cdf
+## each round of draws covers every stratum once, so path i always falls in
+## stratum i % strata - the gatherer needs no extra information
+## mc_stratified keeps moments per stratum and reports the stratified
+## standard error, sqrt(sum(var_s / n_s)) / strata
+## with strata=1 it is an ordinary mean and standard error
+
+def stratified_mc(option, moved_spot, std_dev, discounting, paths, stats_gather, strata):
+
+    if paths % strata != 0 or paths < 2 * strata:
+        raise ValueError("paths must be a multiple of strata, with two paths per stratum!")
+
+    lower = np.arange(strata) / strata
+
+    for i in range(paths // strata):
+        variates = stats.norm.ppf(lower + np.random.uniform(size=strata) / strata)
+        these_spots = moved_spot * np.exp(std_dev * variates)
+
+        for this_spot in these_spots:
+            stats_gather.dump_one_result(discounting * option.calculate_payoff(this_spot))
+
+
+class mc_stratified(mc_statistics):
+    def __init__(self, strata):
+        self._strata = strata
+        self._sums = np.zeros(strata)
+        self._sums_square = np.zeros(strata)
+        self._counts = np.zeros(strata)
+        self._current_paths = 0
+
+    def dump_one_result(self, result):
+        ## the plain route passes one-element arrays
+        result = float(np.asarray(result).squeeze())
+        stratum = self._current_paths % self._strata
+        self._sums[stratum] += result
+        self._sums_square[stratum] += result * result
+        self._counts[stratum] += 1
+        self._current_paths += 1
+
+    def get_results_so_far(self):
+        means = self._sums / self._counts
+        variances = (self._sums_square / self._counts - means * means) * self._counts / (self._counts - 1)
+        std_error = np.sqrt(np.sum(variances / self._counts)) / self._strata
+        return [[np.mean(means), std_error]]
+
+    def deepcopy(self):
+        return cp.deepcopy(self)
+
+
+for strata in (1, 100):
+    np.random.seed(0)
+    gatherer = mc_stratified(strata)
+    simple_mc_main_5(VanillaOption(1, PayOffCall(7)), 5, [0.3, 0.05], 10000, gatherer, strata)
+
+    print(f'{strata} strata: price = {gatherer.get_results_so_far()[0][0]}, std error = {gatherer.get_results_so_far()[0][1]}')
+
+## with one stratum it is an ordinary mean and standard error on the plain route
+
+np.random.seed(0)
+gatherer = mc_stratified(1)
+simple_mc_main_5(VanillaOption(1, PayOffCall(7)), 5, [0.3, 0.05], 10000, gatherer)
+
+print(f'plain route: price = {gatherer.get_results_so_far()[0][0]}, std error = {gatherer.get_results_so_far()[0][1]}')
+
+# 9. importance sampling - shifting the drift
+
+## a deep out-of-the-money or digital payoff is zero on almost every path
+## drawing the Gaussian from N(shift, 1) instead moves the paths to where the
+## payoff lives, and each result is reweighted by the likelihood ratio
+##   exp(-shift * z + 0.5 * shift ** 2)
+## so the estimate stays unbiased - the gatherers see weighted results and need
+## no changes
+## shift="auto" centres the terminal spot on the strike, or on the middle of
+## the band for a double digital
+## stratification combines with it - the strata are laid over N(shift, 1)
+
+class PayOffDoubleDigital(PayOff):
+    def __init__(self, strike):
+        self._lower = strike[0]
+        self._upper = strike[1]
+
+    def get_strike(self):
+        return (self._lower, self._upper)
+
+    def calculate_payoff(self, spot):
+        if self._lower <= spot <= self._upper:
+            return 1
+        else:
+            return 0
+
+def auto_shift(payoff, moved_spot, std_dev):
+    strike = payoff.get_strike()
+
+    if isinstance(strike, np.ndarray):
+        raise ValueError("an automatic shift needs one strike - give a ladder an explicit shift!")
+
+    if isinstance(strike, (tuple, list)):
+        target = np.sqrt(strike[0] * strike[1])
+    else:
+        target = strike
+
+    return np.log(target / moved_spot) / std_dev
+
+def importance_mc(option, moved_spot, std_dev, discounting, paths, stats_gather, strata, shift):
+
+    if shift == "auto":
+        shift = auto_shift(option.get_payoff(), moved_spot, std_dev)
+
+    rounds = paths if strata is None else paths // strata
+
+    if strata is not None and (paths % strata != 0 or paths < 2 * strata):
+        raise ValueError("paths must be a multiple of strata, with two paths per stratum!")
+
+    for i in range(rounds):
+        if strata is None:
+            variates = shift + np.random.normal(0, 1, 1)
+        else:
+            variates = shift + stats.norm.ppf((np.arange(strata) + np.random.uniform(size=strata)) / strata)
+
+        weights = np.exp(-shift * variates + 0.5 * shift * shift)
+        these_spots = moved_spot * np.exp(std_dev * variates)
+
+        for this_spot, weight in zip(these_spots, weights):
+            stats_gather.dump_one_result(discounting * weight * option.calculate_payoff(this_spot))
+
+
+for shift in (None, "auto"):
+    np.random.seed(0)
+    gatherer = mc_stratified(1)
+    simple_mc_main_5(VanillaOption(1, PayOffDoubleDigital((9, 10))), 5, [0.3, 0.05], 10000, gatherer, shift=shift)
+
+    print(f'double digital, shift={shift}: price = {gatherer.get_results_so_far()[0][0]}, std error = {gatherer.get_results_so_far()[0][1]}')
+
+# 10. a time budget - stopping at a deadline instead of a path count
+
+## a quote with a latency limit cannot wait for a fixed number of paths
+## with budget=seconds, simple_mc_main_5 simulates batches of paths and reads
+## a monotonic clock between them - paths becomes an upper limit, and the
+## first batch always runs so there is an estimate to return
+## the function returns (price, std error, paths done) as well as feeding the
+## gatherer, so the caller can see how far it got before the deadline
+## it runs plain draws only - asking for strata or a shift as well is an error
+
+def deadline_mc(option, moved_spot, std_dev, discounting, paths, stats_gather, budget, batch_size=1000):
+    deadline = time.monotonic() + budget
+    done = 0
+    running_sum = 0.0
+    running_sum_square = 0.0
+
+    while done < paths and (done == 0 or time.monotonic() < deadline):
+        this_batch = min(batch_size, paths - done)
+        these_spots = moved_spot * np.exp(std_dev * np.random.normal(0, 1, this_batch))
+
+        for this_spot in these_spots:
+            value = discounting * option.calculate_payoff(this_spot)
+            stats_gather.dump_one_result(value)
+            running_sum += value
+            running_sum_square += value * value
+
+        done += this_batch
+
+    mean = running_sum / done
+    std_error = np.sqrt(np.maximum(running_sum_square / done - mean * mean, 0) / (done - 1)) if done > 1 else np.nan
+
+    return mean, std_error, done
+
+
+for budget in (0.01, 0.1):
+    np.random.seed(0)
+    gatherer = mc_mean()
+    price, std_error, done = simple_mc_main_5(VanillaOption(1, PayOffCall(7)), 5, [0.3, 0.05], 10 ** 8, gatherer, budget=budget)
+
+    print(f'{budget}s budget: price = {price}, std error = {std_error}, paths = {done}')
+
+# 11. moment matching
+
+## each batch of draws is shifted and rescaled to sample mean 0 and variance 1
+## before it is turned into spots - a cheap variance reduction
+## the paths of a batch are then dependent, so mc_batch_means takes the error
+## from the spread of the batch means - its batch_paths must match the batch
+## size of the draws
+## it cannot be combined with strata, a shift or a time budget
+
+def moment_matched_mc(option, moved_spot, std_dev, discounting, paths, stats_gather, batch_size=1000):
+    done = 0
+
+    while done < paths:
+        this_batch = min(batch_size, paths - done)
+        variates = np.random.normal(0, 1, this_batch)
+
+        if this_batch > 1:
+            variates = (variates - np.mean(variates)) / np.std(variates)
+
+        for this_spot in moved_spot * np.exp(std_dev * variates):
+            stats_gather.dump_one_result(discounting * option.calculate_payoff(this_spot))
+
+        done += this_batch
+
+
+class mc_batch_means(mc_statistics):
+    def __init__(self, batch_paths=1000):
+        self._batch_paths = batch_paths
+        self._batch_means = []
+        self._pending_sum = 0
+        self._pending_count = 0
+
+    def dump_one_result(self, result):
+        self._pending_sum += result
+        self._pending_count += 1
+
+        if self._pending_count == self._batch_paths:
+            self._batch_means.append(self._pending_sum / self._batch_paths)
+            self._pending_sum = 0
+            self._pending_count = 0
+
+    def get_results_so_far(self):
+        means = np.array(self._batch_means)
+        mean = (np.sum(means) * self._batch_paths + self._pending_sum) / (len(means) * self._batch_paths + self._pending_count)
+
+        if len(means) < 2:
+            return [[mean, np.nan]]
+
+        return [[mean, np.std(means, ddof=1) / np.sqrt(len(means))]]
+
+    def deepcopy(self):
+        return cp.deepcopy(self)
+
+
+for moment_matching in (False, True):
+    np.random.seed(0)
+    gatherer = mc_batch_means(1000)
+    simple_mc_main_5(VanillaOption(1, PayOffCall(7)), 5, [0.3, 0.05], 50000, gatherer, moment_matching=moment_matching)
+
+    print(f'moment matching={moment_matching}: price = {gatherer.get_results_so_far()[0][0]}, batch-means error = {gatherer.get_results_so_far()[0][1]}')
+
+# 12. a strike ladder from one simulation
+
+## pricing a smile strike by strike draws a fresh set of spots for each strike
+## PayOffLadder evaluates several payoffs on the same spot and returns a vector,
+## so simple_mc_main_5 hands the gatherer one row of discounted payoffs per path
+## mc_mean_vector keeps a running mean and standard error per payoff
+## every route carries the vector through except mc_stratified and
+## mc_batch_means, which gather scalars - and shift="auto", which needs a
+## single strike to aim at
+
+class PayOffLadder(PayOff):
+    def __init__(self, payoffs):
+        self._payoffs = payoffs
+
+    def get_payoffs(self):
+        return self._payoffs
+
+    def get_strike(self):
+        return np.array([payoff.get_strike() for payoff in self._payoffs])
+
+    def calculate_payoff(self, spot):
+        return np.array([float(np.squeeze(payoff.calculate_payoff(spot))) for payoff in self._payoffs])
+
+
+class mc_mean_vector(mc_statistics):
+    def __init__(self):
+        self._running_sum = 0
+        self._running_sum_square = 0
+        self._current_paths = 0
+
+    def dump_one_result(self, result):
+        result = np.asarray(result, dtype=float)
+        self._current_paths += 1
+        self._running_sum = self._running_sum + result
+        self._running_sum_square = self._running_sum_square + result * result
+
+    def get_results_so_far(self):
+        means = self._running_sum / self._current_paths
+        variances = (self._running_sum_square / self._current_paths - means * means) * self._current_paths / (self._current_paths - 1)
+        return [list(means), list(np.sqrt(np.maximum(variances, 0) / self._current_paths))]
+
+    def deepcopy(self):
+        return cp.deepcopy(self)
+
+
+ladder_strikes = np.linspace(4, 10, 13)
+
+np.random.seed(0)
+gatherer = mc_mean_vector()
+simple_mc_main_5(VanillaOption(1, PayOffLadder([PayOffCall(k) for k in ladder_strikes])), 5, [0.3, 0.05], 10000, gatherer)
+ladder_means, ladder_errors = gatherer.get_results_so_far()
+
+np.random.seed(0)
+gatherer = mc_mean()
+simple_mc_main_5(VanillaOption(1, PayOffCall(7)), 5, [0.3, 0.05], 10000, gatherer)
+
+print(f'{len(ladder_means)} strikes from one simulation, strike 7: {ladder_means[6]} +/- {ladder_errors[6]}, on its own: {gatherer.get_results_so_far()[0][0]}')
@@ -24,3 +24,87 @@ class GaussianRandomNumberGenerator(RandomNumberGenerator):
     def get_gaussian(self):
         variates = np.random.normal(size=self._dimensions)
         return variates
+
+
+# a generator that owns its own numpy Generator, with a choice of bit generator,
+# rather than sharing the legacy global state
+# get_gaussian serves one path at a time out of an internal block that is
+# refilled in bulk, and get_gaussian_batch fills the caller's buffer in place
+# both draw from the same stream, so mixing them changes nothing
+# called with no arguments get_gaussian returns a new array, as the generator
+# above does - the engines in chapter 7 pass in a buffer to be filled instead
+
+bit_generators = {
+    "PCG64": np.random.PCG64,
+    "Philox": np.random.Philox,
+    "SFC64": np.random.SFC64,
+}
+
+
+class BufferedGaussianRandomNumberGenerator(RandomNumberGenerator):
+    def __init__(self, dimensions, bit_generator="PCG64", seed=None, block_paths=4096, dtype=np.float64):
+        super().__init__(dimensions)
+
+        if bit_generator not in bit_generators.keys():
+            raise ValueError(f"unknown bit generator {bit_generator}!")
+
+        self._generator = np.random.Generator(bit_generators[bit_generator](seed))
+        self._block_paths = block_paths
+        self._dtype = dtype
+        self.allocate()
+
+    def allocate(self):
+        self._block = np.empty((self._block_paths, self._dimensions), self._dtype)
+        self._position = self._block_paths
+
+    def reset_dimensions(self, new_dimensions):
+        super().reset_dimensions(new_dimensions)
+        self.allocate()
+
+    def reset_dtype(self, new_dtype):
+        self._dtype = new_dtype
+        self.allocate()
+
+    def get_gaussian(self, variates=None):
+        if variates is None:
+            variates = np.empty(self._dimensions, self._dtype)
+
+        if self._position == self._block_paths:
+            self._generator.standard_normal(out=self._block, dtype=self._dtype)
+            self._position = 0
+
+        variates[:] = self._block[self._position]
+        self._position += 1
+        return variates
+
+    def get_gaussian_batch(self, paths, out=None):
+        if out is None:
+            out = np.empty((paths, self._dimensions), self._dtype)
+
+        # whatever is left in the block comes first, the rest straight from the stream
+        buffered = min(self._block_paths - self._position, paths)
+        out[:buffered] = self._block[self._position:self._position + buffered]
+        self._position += buffered
+
+        if buffered < paths:
+            self._generator.standard_normal(out=out[buffered:], dtype=self._dtype)
+
+        return out
+
+    def get_state(self):
+        return (self._generator.bit_generator.state, self._block.copy(), self._position)
+
+    def set_state(self, state):
+        self._generator.bit_generator.state = state[0]
+        self._block = state[1].copy()
+        self._position = state[2]
+
+
+generator = BufferedGaussianRandomNumberGenerator(10, "Philox", seed=0)
+variates = np.zeros(10)
+filled = generator.get_gaussian(variates)
+batch = generator.get_gaussian_batch(1000)
+
+print(f'one path filled in place: {filled is variates}, first variate = {variates[0]}')
+print(f'batch of shape {batch.shape}, mean = {batch.mean()}, std = {batch.std()}')
+print(f'get_gaussian() with no buffer, as GaussianRandomNumberGenerator: {generator.get_gaussian().shape}')
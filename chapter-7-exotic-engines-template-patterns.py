@@ -1,5 +1,21 @@
 import numpy as np
 import copy as cp
+import json
+import os
+import pickle
+import tempfile
+import time
+from collections import OrderedDict
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    from scipy.stats import norm, qmc
+except ImportError:
+    norm = qmc = None
 
 # include required classes - improvement, using __call__ in place of
 # calculate_payoff
@@ -13,14 +29,268 @@ class RandomNumberGenerator:
         self._dimensions = new_dimensions
 
 
+# with moment_matching=True every batch is shifted and rescaled, dimension by
+# dimension, to sample mean 0 and variance 1 - get_gaussian then serves paths
+# out of matched blocks of block_paths
+# draws within a batch are no longer independent, so errors should come from
+# batch means (mc_batch_means) rather than from the spread of single paths
+
 class GaussianRandomNumberGenerator(RandomNumberGenerator):
-    def __init__(self, dimensions):
+    def __init__(self, dimensions, dtype=np.float64, moment_matching=False, block_paths=4096):
+        super().__init__(dimensions)
+        self._dtype = dtype
+        self._moment_matching = moment_matching
+        self._block_paths = block_paths
+        self._block = np.zeros((0, dimensions))
+        self._position = 0
+
+    def reset_dimensions(self, new_dimensions):
+        super().reset_dimensions(new_dimensions)
+        self._block = np.zeros((0, new_dimensions))
+        self._position = 0
+
+    def reset_dtype(self, new_dtype):
+        self._dtype = new_dtype
+
+    def get_gaussian(self, variates):
+        if not self._moment_matching:
+            variates[:] = np.random.normal(size=self._dimensions)
+            return variates
+
+        if self._position == len(self._block):
+            self._block = self.get_gaussian_batch(self._block_paths)
+            self._position = 0
+
+        variates[:] = self._block[self._position]
+        self._position += 1
+        return variates
+
+    def get_gaussian_batch(self, paths, out=None):
+        if out is None:
+            out = np.empty((paths, self._dimensions), self._dtype)
+
+        draws = np.random.normal(size=(paths, self._dimensions))
+
+        if self._moment_matching and paths > 1:
+            draws -= draws.mean(axis=0)
+            draws /= draws.std(axis=0)
+
+        out[:] = draws
+        return out
+
+    def get_state(self):
+        if self._moment_matching:
+            return (np.random.get_state(), self._block.copy(), self._position)
+
+        return np.random.get_state()
+
+    def set_state(self, state):
+        if self._moment_matching:
+            np.random.set_state(state[0])
+            self._block = state[1].copy()
+            self._position = state[2]
+        else:
+            np.random.set_state(state)
+
+
+# a generator that owns its own numpy Generator, with a choice of bit generator,
+# rather than sharing the legacy global state
+# get_gaussian serves one path at a time out of an internal block that is
+# refilled in bulk, and get_gaussian_batch fills the caller's buffer in place
+# both draw from the same stream, so mixing them changes nothing
+
+bit_generators = {
+    "PCG64": np.random.PCG64,
+    "Philox": np.random.Philox,
+    "SFC64": np.random.SFC64,
+}
+
+
+class BufferedGaussianRandomNumberGenerator(RandomNumberGenerator):
+    def __init__(self, dimensions, bit_generator="PCG64", seed=None, block_paths=4096, dtype=np.float64):
+        super().__init__(dimensions)
+
+        if bit_generator not in bit_generators.keys():
+            raise ValueError(f"unknown bit generator {bit_generator}!")
+
+        self._generator = np.random.Generator(bit_generators[bit_generator](seed))
+        self._block_paths = block_paths
+        self._dtype = dtype
+        self.allocate()
+
+    def allocate(self):
+        self._block = np.empty((self._block_paths, self._dimensions), self._dtype)
+        self._position = self._block_paths
+
+    def reset_dimensions(self, new_dimensions):
+        super().reset_dimensions(new_dimensions)
+        self.allocate()
+
+    def reset_dtype(self, new_dtype):
+        self._dtype = new_dtype
+        self.allocate()
+
+    def get_gaussian(self, variates):
+        if self._position == self._block_paths:
+            self._generator.standard_normal(out=self._block, dtype=self._dtype)
+            self._position = 0
+
+        variates[:] = self._block[self._position]
+        self._position += 1
+        return variates
+
+    def get_gaussian_batch(self, paths, out=None):
+        if out is None:
+            out = np.empty((paths, self._dimensions), self._dtype)
+
+        # whatever is left in the block comes first, the rest straight from the stream
+        buffered = min(self._block_paths - self._position, paths)
+        out[:buffered] = self._block[self._position:self._position + buffered]
+        self._position += buffered
+
+        if buffered < paths:
+            self._generator.standard_normal(out=out[buffered:], dtype=self._dtype)
+
+        return out
+
+    def get_state(self):
+        return (self._generator.bit_generator.state, self._block.copy(), self._position)
+
+    def set_state(self, state):
+        self._generator.bit_generator.state = state[0]
+        self._block = state[1].copy()
+        self._position = state[2]
+
+
+# variance-reduced samplers - they plug into any engine in place of the plain
+# generators
+# antithetic: every draw z from the inner generator is followed by -z (within a
+# batch the second half mirrors the first)
+# quasi-random: scrambled Sobol points mapped through the inverse normal cdf
+# stratified: the component of each draw along direction (1, ..., 1) / sqrt(n)
+# - the terminal Brownian value for equally spaced dates - is replaced by a
+# stratified normal, path i landing in stratum i % strata
+# the last two need scipy
+
+class AntitheticGaussianRandomNumberGenerator(RandomNumberGenerator):
+    def __init__(self, inner):
+        super().__init__(inner._dimensions)
+        self._inner = inner
+        self._pending = None
+
+    def reset_dimensions(self, new_dimensions):
+        super().reset_dimensions(new_dimensions)
+        self._inner.reset_dimensions(new_dimensions)
+        self._pending = None
+
+    def reset_dtype(self, new_dtype):
+        self._inner.reset_dtype(new_dtype)
+
+    def get_gaussian(self, variates):
+        if self._pending is None:
+            self._inner.get_gaussian(variates)
+            self._pending = -variates
+        else:
+            variates[:] = self._pending
+            self._pending = None
+
+        return variates
+
+    def get_gaussian_batch(self, paths, out=None):
+        half = (paths + 1) // 2
+        first = self._inner.get_gaussian_batch(half)
+
+        if out is None:
+            out = np.empty((paths, self._dimensions), first.dtype)
+
+        out[:half] = first
+        np.negative(first[:paths - half], out=out[half:])
+        return out
+
+    def get_state(self):
+        return (self._inner.get_state(), self._pending)
+
+    def set_state(self, state):
+        self._inner.set_state(state[0])
+        self._pending = state[1]
+
+
+class SobolGaussianRandomNumberGenerator(RandomNumberGenerator):
+    def __init__(self, dimensions, seed=None, dtype=np.float64):
+        if qmc is None:
+            raise ImportError("scipy is required for quasi-random numbers!")
+
+        super().__init__(dimensions)
+        self._seed = seed
+        self._dtype = dtype
+        self.allocate()
+
+    def allocate(self):
+        self._sobol = qmc.Sobol(self._dimensions, scramble=True, seed=self._seed)
+
+    def reset_dimensions(self, new_dimensions):
+        super().reset_dimensions(new_dimensions)
+        self.allocate()
+
+    def reset_dtype(self, new_dtype):
+        self._dtype = new_dtype
+
+    def get_gaussian(self, variates):
+        variates[:] = norm.ppf(self._sobol.random(1)[0])
+        return variates
+
+    def get_gaussian_batch(self, paths, out=None):
+        if out is None:
+            out = np.empty((paths, self._dimensions), self._dtype)
+
+        out[:] = norm.ppf(self._sobol.random(paths))
+        return out
+
+    def get_state(self):
+        return cp.deepcopy(self._sobol)
+
+    def set_state(self, state):
+        self._sobol = cp.deepcopy(state)
+
+
+class StratifiedGaussianRandomNumberGenerator(RandomNumberGenerator):
+    def __init__(self, dimensions, strata=64, seed=None, dtype=np.float64):
+        if norm is None:
+            raise ImportError("scipy is required for stratified sampling!")
+
         super().__init__(dimensions)
+        self._strata = strata
+        self._generator = np.random.default_rng(seed)
+        self._dtype = dtype
+        self._count = 0
+
+    def reset_dtype(self, new_dtype):
+        self._dtype = new_dtype
 
     def get_gaussian(self, variates):
-        variates = np.random.normal(size=self._dimensions)
+        variates[:] = self.get_gaussian_batch(1)[0]
         return variates
 
+    def get_gaussian_batch(self, paths, out=None):
+        if out is None:
+            out = np.empty((paths, self._dimensions), self._dtype)
+
+        direction = np.full(self._dimensions, 1 / np.sqrt(self._dimensions))
+        strata = (self._count + np.arange(paths)) % self._strata
+        stratified = norm.ppf((strata + self._generator.uniform(size=paths)) / self._strata)
+        variates = self._generator.standard_normal((paths, self._dimensions))
+
+        out[:] = variates + np.outer(stratified - variates @ direction, direction)
+        self._count += paths
+        return out
+
+    def get_state(self):
+        return (self._generator.bit_generator.state, self._count)
+
+    def set_state(self, state):
+        self._generator.bit_generator.state = state[0]
+        self._count = state[1]
+
 
 class ParametersInner:
     def __init__(self):
@@ -72,6 +342,10 @@ class PayOff:
     def __init__(self, strike):
         self._strike = strike
 
+    def columns(self):
+        # payoffs evaluated per spot - more than one for a PayOffLadder
+        return 1
+
     def __call__(self, spot):
         return spot - spot
 
@@ -84,7 +358,7 @@ class PayOffCall(PayOff):
         return self._strike
 
     def __call__(self, spot):
-        return max(self._strike - spot, 0)
+        return np.maximum(self._strike - spot, 0)
 
 
 class VanillaOption:
@@ -126,6 +400,10 @@ class mc_statistics:
     def dump_one_result(self):
         return 0
 
+    def dump_results(self, results):
+        for result in results:
+            self.dump_one_result(result)
+
     def get_results_so_far(self):
         return 0
 
@@ -138,19 +416,38 @@ class mc_statistics:
         pass
 
 
+# the running sum is kept in float64 with a compensation term (Neumaier
+# summation), so float32 path results lose nothing when accumulated
+
 class mc_mean(mc_statistics):
     def __init__(self):
-        self._running_sum = 0
+        self._running_sum = 0.0
+        self._compensation = 0.0
         self._current_paths = 0
 
     def get_results_so_far(self):
         results = [[0]]
-        results[0][0] = self._running_sum / self._current_paths
+        results[0][0] = (self._running_sum + self._compensation) / self._current_paths
         return results
 
+    def accumulate(self, value):
+        value = float(value)
+        total = self._running_sum + value
+
+        if abs(self._running_sum) >= abs(value):
+            self._compensation += (self._running_sum - total) + value
+        else:
+            self._compensation += (value - total) + self._running_sum
+
+        self._running_sum = total
+
     def dump_one_result(self, result):
         self._current_paths += 1
-        self._running_sum += result
+        self.accumulate(result)
+
+    def dump_results(self, results):
+        self._current_paths += len(results)
+        self.accumulate(np.sum(results, dtype=np.float64))
 
     def deepcopy(self):
         return cp.deepcopy(self)
@@ -244,6 +541,40 @@ class PathDependent:
         # base class
         pass
 
+    def fused_statistic(self):
+        # base class - products without a fused kernel return None
+        return None
+
+    def fused_cash_flows(self, statistics):
+        # base class
+        pass
+
+    def importance_target(self):
+        # base class - the spot an importance-sampling shift should aim for
+        return None
+
+    def payoff_columns(self):
+        payoff = getattr(self, "_payoff", None)
+        return 1 if payoff is None else payoff.columns()
+
+    def extra_dimensions(self):
+        # base class - Gaussians per path the product needs beyond the path itself
+        # they come from the engine's generator and are passed to
+        # cash_flow_matrix as extra_variates
+        return 0
+
+    def cash_flow_matrix(self, spot_paths, amounts):
+        # columnar cash flows - amounts[p, j] is paid at possible_cashflow_times()[j]
+        # this default replays cash_flows path by path, override to vectorise
+        generated_flows = [CashFlow() for i in range(self.max_cashflow_number())]
+        amounts[:] = 0
+
+        for p in range(len(spot_paths)):
+            number_flows = self.cash_flows(spot_paths[p], generated_flows)
+
+            for i in range(number_flows):
+                amounts[p, generated_flows[i].time_index] += generated_flows[i].amount
+
     def deepcopy(self):
         return cp.deepcopy(self)
 
@@ -251,34 +582,203 @@ class PathDependent:
         del self
 
 
+# engines that share a time grid and market parameters share their set-up
+# discounts, drifts and standard deviations are built once per key (the grid
+# and the raw parameter values) and kept read-only in a small LRU cache, so
+# hundreds of trades on the same grid pay for one set-up
+
+
+class EngineSetupCache:
+    def __init__(self, max_entries=256):
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, build):
+        if key in self._entries.keys():
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        arrays = build()
+        for array in arrays:
+            array.setflags(write=False)
+
+        self._entries[key] = arrays
+        if len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+        return arrays
+
+    def clear(self):
+        self._entries.clear()
+
+
+engine_setup_cache = EngineSetupCache()
+
+
+# mc_moments passes results through to another gatherer and keeps the count,
+# mean and sum of squared deviations, merging each batch in (Chan et al.) so
+# the standard error is available at any point
+# rows of several results (a PayOffLadder) keep moments per column, and the
+# mean and standard error come back as arrays
+
+class mc_moments(mc_statistics):
+    def __init__(self, inner):
+        self._inner = inner
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._current_paths = 0
+
+    def dump_one_result(self, result):
+        self.dump_results(np.array([result], float))
+
+    def dump_results(self, results):
+        self._inner.dump_results(results)
+        results = np.asarray(results, np.float64)
+
+        if len(results) == 0:
+            return
+
+        results = results.reshape(len(results), -1)
+        count = self._current_paths + len(results)
+        batch_mean = np.mean(results, axis=0)
+        delta = batch_mean - self._mean
+
+        self._m2 = self._m2 + np.sum((results - batch_mean) ** 2, axis=0) + delta * delta * self._current_paths * len(results) / count
+        self._mean = self._mean + delta * len(results) / count
+        self._current_paths = count
+
+    def get_results_so_far(self):
+        mean = self._mean[0] if np.size(self._mean) == 1 else self._mean
+
+        if self._current_paths < 2:
+            return [[mean, np.nan * mean, self._current_paths]]
+
+        std_error = np.sqrt(self._m2 / (self._current_paths - 1) / self._current_paths)
+        return [[mean, std_error[0] if np.size(std_error) == 1 else std_error, self._current_paths]]
+
+    def deepcopy(self):
+        return cp.deepcopy(self)
+
+
+# mc_batch_means splits the results into consecutive batches of batch_paths
+# and reports [mean, std error, full batches], the error coming from the spread
+# of the batch means - it stays honest when paths inside a batch are dependent,
+# as long as the batches line up with the generator's (a trailing partial
+# batch counts towards the mean only)
+
+class mc_batch_means(mc_statistics):
+    def __init__(self, batch_paths=4096):
+        self._batch_paths = batch_paths
+        self._batch_means = []
+        self._pending_sum = 0.0
+        self._pending_count = 0
+
+    def dump_one_result(self, result):
+        self.dump_results(np.array([result], float))
+
+    def dump_results(self, results):
+        results = np.asarray(results, np.float64).ravel()
+
+        while len(results) > 0:
+            take = min(self._batch_paths - self._pending_count, len(results))
+            self._pending_sum += np.sum(results[:take])
+            self._pending_count += take
+            results = results[take:]
+
+            if self._pending_count == self._batch_paths:
+                self._batch_means.append(self._pending_sum / self._batch_paths)
+                self._pending_sum = 0.0
+                self._pending_count = 0
+
+    def get_results_so_far(self):
+        means = np.array(self._batch_means)
+        mean = (np.sum(means) * self._batch_paths + self._pending_sum) / (len(means) * self._batch_paths + self._pending_count)
+
+        if len(means) < 2:
+            return [[mean, np.nan, len(means)]]
+
+        return [[mean, np.std(means, ddof=1) / np.sqrt(len(means)), len(means)]]
+
+    def deepcopy(self):
+        return cp.deepcopy(self)
+
+
 class ExoticEngine:
-    def __init__(self, product, r):
+    def __init__(self, product, r, backend="python", dtype=np.float64):
         self._product = product
         self._r = Parameters(r)
-        self._discounts = self._product.possible_cashflow_times()
+        self._backend = backend
+        self._dtype = dtype
+        self._path_weight = 1.0
 
-        for i in range(len(self._discounts)):
-            self._discounts[i] = np.exp(-self._r.integral(0, self._discounts[i]))
+        cashflow_times = np.asarray(self._product.possible_cashflow_times(), dtype=float)
+        self._discounts, = engine_setup_cache.get(("discounts", cashflow_times.tobytes(), r),
+                                                  lambda: (self.compute_discounts(cashflow_times),))
 
         self._these_cash_flows = []
         for i in range(self._product.max_cashflow_number()):
             self._these_cash_flows.append(CashFlow())
 
+        self._extra_variates = None
+
+    def compute_discounts(self, cashflow_times):
+        return np.array([np.exp(-self._r.integral(0, t)) for t in cashflow_times])
+
     def get_one_path(self, spot_values):
         # base class
         pass
 
-    def do_simulation(self, gatherer, paths):
-        spot_values = self._product.get_look_at_times()
+    def do_simulation(self, gatherer, paths, *, sink=None):
+        spot_values = np.zeros(len(self._product.get_look_at_times()), self._dtype)
+        amounts = np.zeros((1, self._product.max_cashflow_number()))
 
         self._these_cash_flows = []
         for i in range(self._product.max_cashflow_number()):
             self._these_cash_flows.append(CashFlow())
 
+        if sink is not None or self._product.extra_dimensions() > 0:
+            self.require_single_payoff("cash-flow matrix")
+
         for i in range(paths):
             self.get_one_path(spot_values)
-            this_value = self.do_one_path(spot_values)
-            gatherer.dump_one_result(this_value)
+
+            if sink is None and self._product.extra_dimensions() == 0:
+                this_value = self.do_one_path(spot_values)
+            else:
+                self.cash_flow_matrix(spot_values[np.newaxis], amounts)
+                this_value = amounts[0] @ self._discounts
+
+                if sink is not None:
+                    sink.write(amounts * self._path_weight)
+
+            gatherer.dump_one_result(this_value * self._path_weight)
+
+    def do_simulation_within(self, gatherer, budget, max_paths=None, batch_size=4096):
+        deadline = time.monotonic() + budget
+        moments = mc_moments(gatherer)
+        done = 0
+
+        while (max_paths is None or done < max_paths) and (done == 0 or time.monotonic() < deadline):
+            this_batch = batch_size if max_paths is None else min(batch_size, max_paths - done)
+            self.do_simulation(moments, this_batch)
+            done += this_batch
+
+        return moments.get_results_so_far()[0]
+
+    def require_single_payoff(self, route):
+        if self._product.payoff_columns() > 1:
+            raise ValueError(f"a payoff ladder needs the per-path or fused route, the {route} route "
+                             f"holds one amount per cash flow!")
+
+    def cash_flow_matrix(self, spot_paths, amounts):
+        # hands the product the extra variates drawn with the current paths
+        if self._product.extra_dimensions() == 0:
+            self._product.cash_flow_matrix(spot_paths, amounts)
+        else:
+            self._product.cash_flow_matrix(spot_paths, amounts, extra_variates=self._extra_variates)
 
     def do_one_path(self, spot_values):
         number_flows = self._product.cash_flows(spot_values, self._these_cash_flows)
@@ -300,48 +800,154 @@ class ExoticEngine:
 
 class ExoticBSEngine(ExoticEngine):
 
-    def __init__(self, product, vol, d, r, generator, spot):
-        super().__init__(product, r)
-        self._product = product
+    def __init__(self, product, vol, d, r, generator, spot, backend="python", dtype=np.float64, shift=None):
+        super().__init__(product, r, backend, dtype)
         self._vol = Parameters(vol)
         self._d = Parameters(d)
-        self._r = Parameters(r)
         self._generator = generator
-        times = self._product.get_look_at_times()
+        times = np.asarray(self._product.get_look_at_times(), dtype=float)
         self._number_of_times = len(times)
-        self._discounts = self._product.possible_cashflow_times()
 
-        for i in range(len(self._discounts)):
-            self._discounts[i] = np.exp(-self._r.integral(0, self._discounts[i]))
+        self._dimensions = self._number_of_times + self._product.extra_dimensions()
+        self._generator.reset_dimensions(self._dimensions)
+        self._generator.reset_dtype(dtype)
+        self._drifts, self._std_dev = engine_setup_cache.get(("drifts", times.tobytes(), vol, d, r, np.dtype(dtype).str),
+                                                             lambda: self.compute_drifts(times, dtype))
 
-        self._these_cash_flows = []
-        for i in range(self._product.max_cashflow_number()):
-            self._these_cash_flows.append(CashFlow())
+        self._log_spot = dtype(np.log(spot))
+        self._variates = np.zeros(self._dimensions, dtype)
+        self._batch_variates = np.zeros((0, self._dimensions), dtype)
+        self._shift = self.resolve_shift(shift)
 
-        self._generator.reset_dimensions(self._number_of_times)
-        self._drifts = np.zeros(self._number_of_times, float)
-        self._std_dev = np.zeros(self._number_of_times, float)
+    def get_generator(self):
+        return self._generator
 
-        self._variance = self._vol.integral_square(0, times[0])
-        self._drifts[0] = self._r.integral(0, times[0]) - self._d.integral(0, times[0]) - 0.5 * self._variance
-        self._std_dev[0] = np.sqrt(self._variance)
+    def compute_drifts(self, times, dtype):
+        drifts = np.zeros(self._number_of_times, dtype)
+        std_dev = np.zeros(self._number_of_times, dtype)
+        previous_time = 0
 
-        for i in range(1, self._number_of_times, 1):
-            this_variance = self._vol.integral_square(times[i - 1], times[i])
-            self._drifts[i] = self._r.integral(times[i - 1], times[i]) - self._d.integral(times[i - 1], times[i]) - 0.5 * this_variance
-            self._std_dev[i] = np.sqrt(this_variance)
+        for i in range(self._number_of_times):
+            this_variance = self._vol.integral_square(previous_time, times[i])
+            drifts[i] = self._r.integral(previous_time, times[i]) - self._d.integral(previous_time, times[i]) - 0.5 * this_variance
+            std_dev[i] = np.sqrt(this_variance)
+            previous_time = times[i]
 
-        self._log_spot = np.log(spot)
-        self._variates = np.zeros(self._number_of_times, float)
+        return drifts, std_dev
 
     def get_one_path(self, spot_values):
         self._variates = self._generator.get_gaussian(self._variates)
+        self._extra_variates = self._variates[np.newaxis, self._number_of_times:]
+        path_variates = self._variates[:self._number_of_times]
+
+        if self._shift is not None:
+            self._path_weight = np.exp(-path_variates @ self._shift - 0.5 * self._shift @ self._shift)
+            path_variates = path_variates + self._shift
+
         current_log_spot = self._log_spot
 
         for i in range(self._number_of_times):
-            current_log_spot += self._drifts[i] + self._std_dev[i] * self._variates[i]
+            current_log_spot += self._drifts[i] + self._std_dev[i] * path_variates[i]
             spot_values[i] = np.exp(current_log_spot)
 
+    def do_simulation(self, gatherer, paths, batch_size=4096, *, sink=None):
+        if self._backend == "python":
+            return super().do_simulation(gatherer, paths, sink=sink)
+
+        if self._product.fused_statistic() is None:
+            return self.do_simulation_columnar(gatherer, paths, batch_size, sink=sink)
+
+        if sink is not None:
+            self.require_single_payoff("sink")
+
+        kernel = fused_kernels[self._product.fused_statistic()][resolve_backend(self._backend)]
+        done = 0
+
+        while done < paths:
+            this_batch = min(batch_size, paths - done)
+            variates, weights = self.get_variates_batch(this_batch)
+            statistics = kernel(self._log_spot, self._drifts, self._std_dev, variates)
+            values = (self._product.fused_cash_flows(statistics).T * weights).T
+
+            if sink is not None:
+                sink.write(values)
+
+            gatherer.dump_results(self._discounts[0] * values)
+            done += this_batch
+
+    def do_simulation_columnar(self, gatherer, paths, batch_size=4096, *, sink=None):
+        self.require_single_payoff("columnar")
+        amounts = np.zeros((min(batch_size, paths), self._product.max_cashflow_number()), self._dtype)
+        done = 0
+
+        while done < paths:
+            this_batch = min(batch_size, paths - done)
+            variates, weights = self.get_variates_batch(this_batch)
+            spot_paths = spot_paths_numpy(self._log_spot, self._drifts, self._std_dev, variates)
+            self.cash_flow_matrix(spot_paths, amounts[:this_batch])
+
+            if sink is not None:
+                sink.write((amounts[:this_batch].T * weights).T)
+
+            gatherer.dump_results(weights * (amounts[:this_batch] @ self._discounts))
+            done += this_batch
+
+    def do_simulation_controlled(self, gatherer, paths, batch_size=4096):
+        # control variate - the weighted final spot, whose expectation is the forward
+        # the coefficient is the regression slope of the batch
+        self.require_single_payoff("control variate")
+        forward = np.exp(self._log_spot + np.sum(self._drifts + 0.5 * self._std_dev ** 2, dtype=np.float64))
+        amounts = np.zeros((min(batch_size, paths), self._product.max_cashflow_number()), self._dtype)
+        done = 0
+
+        while done < paths:
+            this_batch = min(batch_size, paths - done)
+            variates, weights = self.get_variates_batch(this_batch)
+            spot_paths = spot_paths_numpy(self._log_spot, self._drifts, self._std_dev, variates)
+            self.cash_flow_matrix(spot_paths, amounts[:this_batch])
+
+            values = weights * (amounts[:this_batch] @ self._discounts)
+            control = weights * spot_paths[:, -1] - forward
+
+            if this_batch > 1 and np.var(control) > 0:
+                beta = np.mean((values - np.mean(values)) * control) / np.var(control)
+                values = values - beta * control
+
+            gatherer.dump_results(values)
+            done += this_batch
+
+    def get_variates_batch(self, paths):
+        # the path variates - any extra ones the product asked for are kept aside
+        if len(self._batch_variates) < paths:
+            self._batch_variates = np.zeros((paths, self._dimensions), self._dtype)
+
+        variates = self._generator.get_gaussian_batch(paths, self._batch_variates[:paths])
+        self._extra_variates = variates[:, self._number_of_times:]
+        variates = variates[:, :self._number_of_times]
+
+        if self._shift is None:
+            return variates, 1.0
+
+        weights = np.exp(-variates @ self._shift - 0.5 * self._shift @ self._shift)
+        variates += self._shift
+        return variates, weights
+
+    def resolve_shift(self, shift):
+        if shift is None:
+            return None
+
+        if isinstance(shift, str) and shift == "auto":
+            target = self._product.importance_target()
+
+            if target is None:
+                raise ValueError("product has no importance target for an automatic shift!")
+
+            # the smallest shift (in norm) that moves the median final log-spot onto the target
+            scale = (np.log(target) - self._log_spot - np.sum(self._drifts)) / np.sum(self._std_dev ** 2)
+            return (scale * self._std_dev).astype(self._dtype)
+
+        return np.broadcast_to(np.asarray(shift, self._dtype), (self._number_of_times,)).copy()
+
 # 6. an arithmetic Asian option - a specific dependent path (PathDependent)
 
 
@@ -367,6 +973,18 @@ class PathDependentAsian(PathDependent):
         generated_flows[0].amount = self._payoff(mean_)
         return 1
 
+    def fused_statistic(self):
+        return "arithmetic_mean"
+
+    def fused_cash_flows(self, statistics):
+        return self._payoff(statistics)
+
+    def cash_flow_matrix(self, spot_paths, amounts):
+        amounts[:, 0] = self._payoff(spot_paths.mean(axis=1))
+
+    def importance_target(self):
+        return self._payoff.get_strike()
+
 # 7. putting them altogether
 
 # since this is a rather complicated process of jumbling items together
@@ -403,3 +1021,1009 @@ for i in range(len(results)):
         print(results[i][j])
 
 ## and this returns - the Asian option price using an exotic BS engine!
+
+# 8. compiled kernels - an optional backend for the hot loops
+
+# get_one_path and do_one_path are called once per path, so the interpreter
+# dominates the cost of a simulation
+# backend="numba" fuses path generation and the path statistic into a single
+# compiled loop - no (paths x dates) spot matrix is ever formed
+# backend="numpy" is the fallback when numba is not installed - it reuses the
+# variates buffer in place, so the only temporary is the batch of draws
+# the single cash flow of a fused product sits at time index 0
+
+
+def resolve_backend(backend):
+    if backend not in ("python", "numpy", "numba"):
+        raise ValueError(f"unknown backend {backend}!")
+
+    if backend == "numba" and numba is None:
+        return "numpy"
+
+    return backend
+
+
+def spot_paths_numpy(log_spot, drifts, std_dev, variates):
+    # overwrites the variates - they are not needed once the paths exist
+    log_paths = variates
+    log_paths *= std_dev
+    log_paths += drifts
+    np.cumsum(log_paths, axis=1, out=log_paths)
+    log_paths += log_spot
+    np.exp(log_paths, out=log_paths)
+    return log_paths
+
+
+def arithmetic_mean_numpy(log_spot, drifts, std_dev, variates):
+    return spot_paths_numpy(log_spot, drifts, std_dev, variates).mean(axis=1)
+
+
+def arithmetic_mean_loop(log_spot, drifts, std_dev, variates):
+    paths, dates = variates.shape
+    means = np.empty(paths, variates.dtype)
+
+    for p in range(paths):
+        current_log_spot = log_spot
+        running_sum = 0.0
+
+        for i in range(dates):
+            current_log_spot += drifts[i] + std_dev[i] * variates[p, i]
+            running_sum += np.exp(current_log_spot)
+
+        means[p] = running_sum / dates
+
+    return means
+
+
+fused_kernels = {
+    "arithmetic_mean": {
+        "numpy": arithmetic_mean_numpy,
+        "numba": numba.njit(arithmetic_mean_loop) if numba is not None else arithmetic_mean_numpy,
+    },
+}
+
+for backend in ("python", "numpy", "numba"):
+    np.random.seed(0)
+    option = PathDependentAsian(times, expiry, payoff)
+    gatherer = mc_mean()
+    generator = GaussianRandomNumberGenerator(dates)
+    engine = ExoticBSEngine(option, vol, d, r, generator, spot, backend=backend)
+    engine.do_simulation(gatherer, 10000)
+
+    print(f'{backend} backend Asian price = {gatherer.get_results_so_far()[0][0]}')
+
+# 9. single precision paths
+
+# the engine is bound by memory traffic, not arithmetic - dtype=np.float32
+# halves the bytes moved per path and doubles the batch that fits in cache
+# only the paths are single precision - mc_mean accumulates in float64, so
+# the pricing error is the float32 rounding of each path, not of the sum
+
+prices = {}
+
+for dtype in (np.float64, np.float32):
+    np.random.seed(0)
+    option = PathDependentAsian(times, expiry, payoff)
+    gatherer = mc_mean()
+    generator = GaussianRandomNumberGenerator(dates)
+    engine = ExoticBSEngine(option, vol, d, r, generator, spot, backend="numpy", dtype=dtype)
+    engine.do_simulation(gatherer, 100000)
+    prices[dtype] = gatherer.get_results_so_far()[0][0]
+
+relative_error = abs(prices[np.float32] - prices[np.float64]) / prices[np.float64]
+
+if relative_error > 1e-4:
+    raise ValueError(f"float32 paths moved the price by {relative_error}!")
+
+print(f'float32 Asian price = {prices[np.float32]}, relative error = {relative_error}')
+
+# 10. columnar cash flows
+
+# cash_flows fills a list of CashFlow objects one path at a time
+# cash_flow_matrix writes a whole batch at once - a (paths x max_cashflow_number)
+# amount matrix whose column j is paid at possible_cashflow_times()[j]
+# the engine then discounts every path with a single matrix-vector product
+# products that only implement cash_flows still work through the default,
+# which replays them path by path into the matrix
+
+# a strip of options - one cash flow per look-at time, so several columns
+
+
+class PathDependentStrip(PathDependent):
+    def __init__(self, look_at_times, payoff):
+        super().__init__(look_at_times)
+        self._payoff = payoff
+        self._number_of_times = len(look_at_times)
+
+    def max_cashflow_number(self):
+        return self._number_of_times
+
+    def possible_cashflow_times(self):
+        return np.array(self._look_at_times, dtype=float)
+
+    def cash_flows(self, spot_values, generated_flows):
+        for i in range(self._number_of_times):
+            generated_flows[i].time_index = i
+            generated_flows[i].amount = self._payoff(spot_values[i])
+        return self._number_of_times
+
+    def cash_flow_matrix(self, spot_paths, amounts):
+        amounts[:] = self._payoff(spot_paths)
+
+
+for backend in ("python", "numpy"):
+    np.random.seed(0)
+    option = PathDependentStrip(times, payoff)
+    gatherer = mc_mean()
+    generator = GaussianRandomNumberGenerator(dates)
+    engine = ExoticBSEngine(option, vol, d, r, generator, spot, backend=backend)
+    engine.do_simulation(gatherer, 10000)
+
+    print(f'{backend} backend strip price = {gatherer.get_results_so_far()[0][0]}')
+
+# 11. barrier and lookback options - Brownian-bridge corrections
+
+# a discretely monitored path misses every crossing that happens between two
+# fixings, so continuous monitoring needs a very fine grid of look-at times
+# conditional on the fixings, log-spot between them is a Brownian bridge and
+# the chance it crossed a barrier b is known in closed form:
+#   p = exp(-2 (b - x1)(b - x2) / variance)   (both fixings on the same side)
+# the barrier product multiplies the payoff by the survival probability
+# prod(1 - p) instead of checking the fixings only, which is accurate on a
+# coarse grid and smoother than a 0/1 knock-out
+# the lookback draws the extremum of each bridge exactly from one uniform U,
+# as -2 log U = z1^2 + z2^2 for two extra Gaussians from the engine's generator
+# - the price then depends on the generator alone, and checkpoints cover it
+
+# monitoring runs from the first to the last look-at time - include time 0 in
+# the look-at times to monitor from inception
+# barriers is a (lower, upper) pair, None for a missing side
+
+
+class PathDependentBarrier(PathDependent):
+    def __init__(self, look_at_times, delivery_time, payoff, barriers, vol, knock="out", bridge=True):
+        super().__init__(look_at_times)
+        self._delivery_time = delivery_time
+        self._payoff = payoff
+        self._lower = barriers[0]
+        self._upper = barriers[1]
+        self._vol = Parameters(vol)
+        self._bridge = bridge
+
+        if knock not in ("in", "out"):
+            raise ValueError(f"unknown knock type {knock}!")
+
+        self._knock = knock
+        self._variances = np.array([self._vol.integral_square(look_at_times[i - 1], look_at_times[i])
+                                    for i in range(1, len(look_at_times))])
+
+    def max_cashflow_number(self):
+        return 1
+
+    def possible_cashflow_times(self):
+        temp = np.zeros(1)
+        temp[0] = self._delivery_time
+        return temp
+
+    def importance_target(self):
+        if self._knock == "out":
+            return self._payoff.get_strike()
+
+        return self._lower if self._lower is not None else self._upper
+
+    def survival(self, spot_paths):
+        log_paths = np.log(spot_paths)
+        alive = np.ones(len(spot_paths))
+
+        for barrier, sign in ((self._lower, -1), (self._upper, 1)):
+            if barrier is None:
+                continue
+
+            distance = sign * (np.log(barrier) - log_paths)
+            alive *= np.all(distance > 0, axis=1)
+
+            if self._bridge:
+                crossing = np.exp(-2 * distance[:, :-1] * distance[:, 1:] / self._variances)
+                alive *= np.prod(1 - np.minimum(crossing, 1), axis=1)
+
+        return alive
+
+    def cash_flow_matrix(self, spot_paths, amounts):
+        survival = self.survival(spot_paths)
+
+        if self._knock == "in":
+            survival = 1 - survival
+
+        amounts[:, 0] = self._payoff(spot_paths[:, -1]) * survival
+
+    def cash_flows(self, spot_values, generated_flows):
+        amounts = np.zeros((1, 1))
+        self.cash_flow_matrix(spot_values[np.newaxis], amounts)
+        generated_flows[0].time_index = 0
+        generated_flows[0].amount = amounts[0, 0]
+        return 1
+
+
+class PathDependentLookback(PathDependent):
+    def __init__(self, look_at_times, delivery_time, payoff, vol, extremum="max", bridge=True):
+        super().__init__(look_at_times)
+        self._delivery_time = delivery_time
+        self._payoff = payoff
+        self._vol = Parameters(vol)
+        self._bridge = bridge
+
+        if extremum not in ("max", "min"):
+            raise ValueError(f"unknown extremum {extremum}!")
+
+        self._sign = 1 if extremum == "max" else -1
+        self._variances = np.array([self._vol.integral_square(look_at_times[i - 1], look_at_times[i])
+                                    for i in range(1, len(look_at_times))])
+
+    def max_cashflow_number(self):
+        return 1
+
+    def possible_cashflow_times(self):
+        temp = np.zeros(1)
+        temp[0] = self._delivery_time
+        return temp
+
+    def extra_dimensions(self):
+        return 2 * len(self._variances) if self._bridge else 0
+
+    def extremum(self, spot_paths, extra_variates=None):
+        log_paths = np.log(spot_paths)
+
+        if not self._bridge:
+            return np.exp(self._sign * np.max(self._sign * log_paths, axis=1))
+
+        if extra_variates is None:
+            raise ValueError("the bridge extremum needs extra_dimensions() Gaussians per path from the engine!")
+
+        start = log_paths[:, :-1]
+        end = log_paths[:, 1:]
+        exponentials = extra_variates[:, 0::2] ** 2 + extra_variates[:, 1::2] ** 2
+        spread = np.sqrt((end - start) ** 2 + self._variances * exponentials)
+        bridge_extrema = 0.5 * (start + end + self._sign * spread)
+
+        return np.exp(self._sign * np.max(self._sign * bridge_extrema, axis=1))
+
+    def cash_flow_matrix(self, spot_paths, amounts, extra_variates=None):
+        amounts[:, 0] = self._payoff(self.extremum(spot_paths, extra_variates))
+
+    def cash_flows(self, spot_values, generated_flows):
+        amounts = np.zeros((1, 1))
+        self.cash_flow_matrix(spot_values[np.newaxis], amounts)
+        generated_flows[0].time_index = 0
+        generated_flows[0].amount = amounts[0, 0]
+        return 1
+
+
+# a down-and-out on 12 monthly fixings with the bridge correction against
+# 500 fixings without it
+
+barrier_spot = 100
+barrier_vol = 0.2
+
+for fixings, bridge in ((12, True), (500, False)):
+    np.random.seed(0)
+    barrier_times = np.linspace(0, 1, fixings + 1)
+    option = PathDependentBarrier(barrier_times, 1, PayOffCall(110), (85, None), barrier_vol, "out", bridge)
+    gatherer = mc_mean()
+    generator = GaussianRandomNumberGenerator(fixings + 1)
+    engine = ExoticBSEngine(option, barrier_vol, 0, 0.05, generator, barrier_spot, backend="numpy")
+    engine.do_simulation(gatherer, 20000)
+
+    print(f'down-and-out, {fixings} fixings, bridge={bridge}: {gatherer.get_results_so_far()[0][0]}')
+
+for fixings, bridge in ((12, True), (500, False)):
+    np.random.seed(0)
+    lookback_times = np.linspace(0, 1, fixings + 1)
+    option = PathDependentLookback(lookback_times, 1, PayOffCall(110), barrier_vol, "min", bridge)
+    gatherer = mc_mean()
+    generator = GaussianRandomNumberGenerator(fixings + 1)
+    engine = ExoticBSEngine(option, barrier_vol, 0, 0.05, generator, barrier_spot, backend="numpy")
+    engine.do_simulation(gatherer, 20000)
+
+    print(f'lookback on the minimum, {fixings} fixings, bridge={bridge}: {gatherer.get_results_so_far()[0][0]}')
+
+# 12. several correlated underlyings - a multi-asset Black-Scholes engine
+
+# the Cholesky factor of the correlation matrix is taken once, at construction
+# each batch draws (paths x dates x assets) variates in one call and
+# correlates them all with a single batched matrix multiply
+# products receive spot_paths of shape (paths x dates x assets)
+
+
+class ExoticBSMultiEngine(ExoticEngine):
+
+    def __init__(self, product, vols, ds, r, correlation, generator, spots, dtype=np.float64):
+        super().__init__(product, r, "numpy", dtype)
+        self._generator = generator
+        times = self._product.get_look_at_times()
+        self._number_of_times = len(times)
+        self._number_of_assets = len(spots)
+        self._cholesky = np.linalg.cholesky(np.asarray(correlation, float)).astype(dtype)
+
+        self._generator.reset_dimensions(self._number_of_times * self._number_of_assets)
+        self._generator.reset_dtype(dtype)
+        self._drifts = np.zeros((self._number_of_times, self._number_of_assets), dtype)
+        self._std_dev = np.zeros((self._number_of_times, self._number_of_assets), dtype)
+
+        for j in range(self._number_of_assets):
+            vol = Parameters(vols[j])
+            d = Parameters(ds[j])
+            previous_time = 0
+
+            for i in range(self._number_of_times):
+                this_variance = vol.integral_square(previous_time, times[i])
+                self._drifts[i, j] = self._r.integral(previous_time, times[i]) - d.integral(previous_time, times[i]) - 0.5 * this_variance
+                self._std_dev[i, j] = np.sqrt(this_variance)
+                previous_time = times[i]
+
+        self._log_spots = np.log(np.asarray(spots, float)).astype(dtype)
+
+    def get_generator(self):
+        return self._generator
+
+    def get_paths(self, paths):
+        variates = self._generator.get_gaussian_batch(paths)
+        variates = variates.reshape(paths, self._number_of_times, self._number_of_assets)
+
+        log_paths = variates @ self._cholesky.T
+        log_paths *= self._std_dev
+        log_paths += self._drifts
+        np.cumsum(log_paths, axis=1, out=log_paths)
+        log_paths += self._log_spots
+        np.exp(log_paths, out=log_paths)
+        return log_paths
+
+    def do_simulation(self, gatherer, paths, batch_size=4096, *, sink=None):
+        self.require_single_payoff("multi-asset")
+        amounts = np.zeros((min(batch_size, paths), self._product.max_cashflow_number()), self._dtype)
+        done = 0
+
+        while done < paths:
+            this_batch = min(batch_size, paths - done)
+            spot_paths = self.get_paths(this_batch)
+            self._product.cash_flow_matrix(spot_paths, amounts[:this_batch])
+
+            if sink is not None:
+                sink.write(amounts[:this_batch])
+
+            gatherer.dump_results(amounts[:this_batch] @ self._discounts)
+            done += this_batch
+
+
+# a basket pays on the weighted sum of the final spots, a rainbow on the best
+# (or worst) of them
+
+
+class PathDependentBasket(PathDependent):
+    def __init__(self, look_at_times, delivery_time, payoff, weights):
+        super().__init__(look_at_times)
+        self._delivery_time = delivery_time
+        self._payoff = payoff
+        self._weights = np.asarray(weights, float)
+
+    def max_cashflow_number(self):
+        return 1
+
+    def possible_cashflow_times(self):
+        temp = np.zeros(1)
+        temp[0] = self._delivery_time
+        return temp
+
+    def cash_flow_matrix(self, spot_paths, amounts):
+        amounts[:, 0] = self._payoff(spot_paths[:, -1, :] @ self._weights)
+
+    def cash_flows(self, spot_values, generated_flows):
+        amounts = np.zeros((1, 1))
+        self.cash_flow_matrix(spot_values[np.newaxis], amounts)
+        generated_flows[0].time_index = 0
+        generated_flows[0].amount = amounts[0, 0]
+        return 1
+
+
+class PathDependentRainbow(PathDependent):
+    def __init__(self, look_at_times, delivery_time, payoff, best=True):
+        super().__init__(look_at_times)
+        self._delivery_time = delivery_time
+        self._payoff = payoff
+        self._best = best
+
+    def max_cashflow_number(self):
+        return 1
+
+    def possible_cashflow_times(self):
+        temp = np.zeros(1)
+        temp[0] = self._delivery_time
+        return temp
+
+    def cash_flow_matrix(self, spot_paths, amounts):
+        if self._best:
+            amounts[:, 0] = self._payoff(np.max(spot_paths[:, -1, :], axis=1))
+        else:
+            amounts[:, 0] = self._payoff(np.min(spot_paths[:, -1, :], axis=1))
+
+    def cash_flows(self, spot_values, generated_flows):
+        amounts = np.zeros((1, 1))
+        self.cash_flow_matrix(spot_values[np.newaxis], amounts)
+        generated_flows[0].time_index = 0
+        generated_flows[0].amount = amounts[0, 0]
+        return 1
+
+
+basket_times = np.array([1.0])
+correlation = np.array([[1.0, 0.5, 0.2],
+                        [0.5, 1.0, 0.3],
+                        [0.2, 0.3, 1.0]])
+
+for option in (PathDependentBasket(basket_times, 1, PayOffCall(100), [0.4, 0.3, 0.3]),
+               PathDependentRainbow(basket_times, 1, PayOffCall(100), best=False)):
+    np.random.seed(0)
+    gatherer = mc_mean()
+    generator = GaussianRandomNumberGenerator(1)
+    engine = ExoticBSMultiEngine(option, [0.2, 0.25, 0.3], [0, 0, 0], 0.05, correlation, generator, [100, 95, 105])
+    engine.do_simulation(gatherer, 20000)
+
+    print(f'{type(option).__name__} price = {gatherer.get_results_so_far()[0][0]}')
+
+# 13. checkpoints - resuming and topping up a simulation
+
+# a run that is interrupted, or turns out to need more paths, should not
+# start again from zero
+# a checkpoint holds the gatherer and the state of the engine's random number
+# generator, so a resumed run draws exactly the paths a single run would have
+# N + M paths only equal a single run bit for bit if the sums are taken over
+# the same groups of paths - mc_blocked decorates a gatherer and forwards
+# results in fixed blocks counted from the first path, carrying a partial
+# block over in the checkpoint
+# a checkpoint is written to a temporary file next to it and then renamed over
+# it, so an interruption mid-write leaves the previous checkpoint intact
+
+
+class mc_blocked(mc_statistics):
+    def __init__(self, inner, block_size=4096):
+        self._inner = inner
+        self._block_size = block_size
+        self._pending = np.zeros(block_size)
+        self._pending_count = 0
+
+    def deepcopy(self):
+        return cp.deepcopy(self)
+
+    def dump_one_result(self, result):
+        self.dump_results(np.array([result], float))
+
+    def dump_results(self, results):
+        results = np.asarray(results, float).ravel()
+
+        while len(results) > 0:
+            take = min(self._block_size - self._pending_count, len(results))
+            self._pending[self._pending_count:self._pending_count + take] = results[:take]
+            self._pending_count += take
+            results = results[take:]
+
+            if self._pending_count == self._block_size:
+                self._inner.dump_results(self._pending.copy())
+                self._pending_count = 0
+
+    def get_results_so_far(self):
+        inner = cp.deepcopy(self._inner)
+
+        if self._pending_count > 0:
+            inner.dump_results(self._pending[:self._pending_count].copy())
+
+        return inner.get_results_so_far()
+
+
+class MonteCarloRun:
+    def __init__(self, engine, gatherer, path, checkpoint_every=100000, paths_done=0):
+        self._engine = engine
+        self._gatherer = gatherer
+        self._path = path
+        self._checkpoint_every = checkpoint_every
+        self._paths_done = paths_done
+
+    def get_paths_done(self):
+        return self._paths_done
+
+    def get_gatherer(self):
+        return self._gatherer
+
+    def run(self, paths):
+        remaining = paths
+
+        while remaining > 0:
+            this_chunk = min(self._checkpoint_every, remaining)
+            self._engine.do_simulation(self._gatherer, this_chunk)
+            self._paths_done += this_chunk
+            remaining -= this_chunk
+            self.save()
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self._path))
+        handle, temporary_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+
+        try:
+            with os.fdopen(handle, "wb") as checkpoint:
+                pickle.dump((self._gatherer, self._paths_done, self._engine.get_generator().get_state()), checkpoint)
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+
+            os.replace(temporary_path, self._path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+
+def resume_run(engine, path, checkpoint_every=100000):
+    with open(path, "rb") as checkpoint:
+        gatherer, paths_done, state = pickle.load(checkpoint)
+
+    engine.get_generator().set_state(state)
+    return MonteCarloRun(engine, gatherer, path, checkpoint_every, paths_done)
+
+
+checkpoint_path = os.path.join(tempfile.mkdtemp(), "asian.checkpoint")
+
+np.random.seed(0)
+engine = ExoticBSEngine(PathDependentAsian(times, expiry, payoff), vol, d, r, GaussianRandomNumberGenerator(dates), spot, backend="numpy")
+single_run = MonteCarloRun(engine, mc_blocked(mc_mean()), checkpoint_path)
+single_run.run(17000)
+
+np.random.seed(0)
+first_run = MonteCarloRun(engine, mc_blocked(mc_mean()), checkpoint_path)
+first_run.run(10000)
+
+resumed_run = resume_run(engine, checkpoint_path)
+resumed_run.run(7000)
+
+single_price = single_run.get_gatherer().get_results_so_far()[0][0]
+resumed_price = resumed_run.get_gatherer().get_results_so_far()[0][0]
+
+if single_price != resumed_price:
+    raise ValueError("resumed run does not match the single run!")
+
+print(f'{resumed_run.get_paths_done()} paths, resumed price = {resumed_price}')
+
+# 14. an array-backed convergence table
+
+# mc_convergence snapshots only when the path count hits a power of two
+# exactly, so batches of results jump straight over its checkpoints, and it
+# builds its table out of lists appended to the inner gatherer's results
+# mc_convergence_table keeps its own running moments and records each
+# checkpoint into preallocated arrays - mean, standard error, path count and
+# elapsed time
+# a batch that crosses one or more checkpoints is split with a cumulative sum,
+# so every checkpoint is recorded at exactly its path count
+# schedules are geometric (first, first * step, ...) or linear
+# (first, first + step, ...) - the schedule itself may be fractional (step=1.5),
+# each point is recorded at the path count it rounds up to, once
+# to_array gives a structured array, ready for pandas.DataFrame
+
+
+class mc_convergence_table(mc_statistics):
+    def __init__(self, schedule="geometric", first=2, step=2, capacity=64):
+        if schedule not in ("geometric", "linear"):
+            raise ValueError(f"unknown schedule {schedule}!")
+
+        if first < 1 or (schedule == "geometric" and step <= 1) or (schedule == "linear" and step <= 0):
+            raise ValueError("the schedule must start at one path or more and increase!")
+
+        self._schedule = schedule
+        self._step = step
+        self._schedule_point = first
+        self._next_checkpoint = int(np.ceil(first))
+        self._checkpoints = 0
+        self._paths = np.zeros(capacity, np.int64)
+        self._means = np.zeros(capacity)
+        self._std_errors = np.zeros(capacity)
+        self._elapsed = np.zeros(capacity)
+
+        self._current_paths = 0
+        self._running_sum = 0.0
+        self._running_sum_square = 0.0
+        self._start = time.perf_counter()
+
+    def deepcopy(self):
+        return cp.deepcopy(self)
+
+    def dump_one_result(self, result):
+        self.dump_results(np.array([result], float))
+
+    def dump_results(self, results):
+        results = np.asarray(results, np.float64).ravel()
+        end = self._current_paths + len(results)
+
+        if self._next_checkpoint <= end:
+            sums = np.cumsum(results)
+            sums_square = np.cumsum(results * results)
+
+            while self._next_checkpoint <= end:
+                i = self._next_checkpoint - self._current_paths - 1
+                self.record(self._next_checkpoint, self._running_sum + sums[i], self._running_sum_square + sums_square[i])
+                self.advance()
+
+        self._current_paths = end
+        self._running_sum += np.sum(results)
+        self._running_sum_square += np.sum(results * results)
+
+    def advance(self):
+        # points that round up to a path count already recorded are skipped
+        while int(np.ceil(self._schedule_point)) <= self._next_checkpoint:
+            if self._schedule == "geometric":
+                self._schedule_point *= self._step
+            else:
+                self._schedule_point += self._step
+
+        self._next_checkpoint = int(np.ceil(self._schedule_point))
+
+    def record(self, paths, total, total_square):
+        if self._checkpoints == len(self._paths):
+            for name in ("_paths", "_means", "_std_errors", "_elapsed"):
+                column = getattr(self, name)
+                setattr(self, name, np.concatenate([column, np.zeros_like(column)]))
+
+        mean = total / paths
+        variance = max(total_square / paths - mean * mean, 0) * paths / max(paths - 1, 1)
+
+        self._paths[self._checkpoints] = paths
+        self._means[self._checkpoints] = mean
+        self._std_errors[self._checkpoints] = np.sqrt(variance / paths)
+        self._elapsed[self._checkpoints] = time.perf_counter() - self._start
+        self._checkpoints += 1
+
+    def to_array(self):
+        table = np.zeros(self._checkpoints, dtype=[("paths", np.int64), ("mean", np.float64),
+                                                   ("std_error", np.float64), ("elapsed", np.float64)])
+        table["paths"] = self._paths[:self._checkpoints]
+        table["mean"] = self._means[:self._checkpoints]
+        table["std_error"] = self._std_errors[:self._checkpoints]
+        table["elapsed"] = self._elapsed[:self._checkpoints]
+        return table
+
+    def get_results_so_far(self):
+        results = [list(row) for row in self.to_array().tolist()]
+
+        if self._current_paths > 0 and (self._checkpoints == 0 or self._paths[self._checkpoints - 1] != self._current_paths):
+            snapshot = self.deepcopy()
+            snapshot.record(self._current_paths, self._running_sum, self._running_sum_square)
+            results.append(list(snapshot.to_array().tolist()[-1]))
+
+        return results
+
+
+np.random.seed(0)
+gatherer = mc_convergence_table(schedule="linear", first=5000, step=5000)
+engine = ExoticBSEngine(PathDependentAsian(times, expiry, payoff), vol, d, r, GaussianRandomNumberGenerator(dates), spot, backend="numpy")
+engine.do_simulation(gatherer, 32000)
+
+for paths_, mean_, std_error_, elapsed_ in gatherer.get_results_so_far():
+    print(f'{paths_} paths: {mean_} +/- {std_error_}')
+
+# 15. importance sampling - shifting the drift of the paths
+
+# a far out-of-the-money trade pays on a handful of paths only
+# shift draws the variates from N(shift, 1) per date and weights every path
+# by the likelihood ratio exp(-shift . z - 0.5 |shift| ** 2) of its unshifted
+# draws z, so the estimate stays unbiased and gatherers need no changes
+# shift="auto" asks the product for an importance_target (the strike, or the
+# barrier of a knock-in) and takes the smallest shift that moves the median
+# final spot onto it
+
+monthly_times = np.linspace(1, 12, 12) / 12
+
+for shift in (None, "auto"):
+    np.random.seed(0)
+    gatherer = mc_convergence_table(first=20000)
+    option = PathDependentAsian(monthly_times, 1, PayOffCall(70))
+    engine = ExoticBSEngine(option, 0.2, 0, 0.05, GaussianRandomNumberGenerator(12), 100, backend="numpy", shift=shift)
+    engine.do_simulation(gatherer, 20000)
+
+    paths_, mean_, std_error_, elapsed_ = gatherer.get_results_so_far()[0]
+    print(f'deep out-of-the-money Asian, shift={shift}: {mean_} +/- {std_error_}')
+
+# 16. a buffered generator with its own bit generator
+
+# the engines work unchanged with BufferedGaussianRandomNumberGenerator - per
+# path draws come out of a block refilled in bulk, batches are filled in place
+
+for bit_generator in ("PCG64", "Philox", "SFC64"):
+    gatherer = mc_mean()
+    generator = BufferedGaussianRandomNumberGenerator(dates, bit_generator, seed=0)
+    engine = ExoticBSEngine(PathDependentAsian(times, expiry, payoff), vol, d, r, generator, spot, backend="numpy")
+    engine.do_simulation(gatherer, 10000)
+
+    print(f'{bit_generator} Asian price = {gatherer.get_results_so_far()[0][0]}')
+
+# 17. sharing engine set-up across trades
+
+# every ExoticBSEngine above on the same look-at times and market parameters
+# has been reading its discounts, drifts and standard deviations out of
+# engine_setup_cache rather than rebuilding them
+
+engine_setup_cache.clear()
+start = time.perf_counter()
+
+for i in range(500):
+    engine = ExoticBSEngine(PathDependentAsian(times, expiry, PayOffCall(strike + i / 100)), vol, d, r,
+                            GaussianRandomNumberGenerator(dates), spot, backend="numpy")
+
+print(f'500 engines built in {time.perf_counter() - start:.3f}s sharing {len(engine_setup_cache)} set-ups')
+
+# 18. a strike ladder from one simulation
+
+# pricing a smile strike by strike runs one simulation per strike
+# PayOffLadder evaluates several payoffs on the same spots and returns a
+# (paths x payoffs) matrix - as the payoff of a product, the engine then
+# hands whole rows of discounted values to the gatherer
+# mc_mean_vector keeps a running mean and standard error per column
+# the per-path engine and the fused kernels carry the extra axis through -
+# the routes built on cash_flow_matrix (columnar products, the control
+# variate, the multi-asset engine, a sink) hold one amount per cash flow and
+# raise a ValueError for a ladder
+
+
+class PayOffLadder(PayOff):
+    def __init__(self, payoffs):
+        self._payoffs = payoffs
+
+    def get_payoffs(self):
+        return self._payoffs
+
+    def get_strike(self):
+        return np.array([payoff.get_strike() for payoff in self._payoffs])
+
+    def columns(self):
+        return len(self._payoffs)
+
+    def __call__(self, spot):
+        return np.stack([payoff(spot) for payoff in self._payoffs], axis=-1)
+
+
+class mc_mean_vector(mc_statistics):
+    def __init__(self):
+        self._running_sum = 0.0
+        self._running_sum_square = 0.0
+        self._current_paths = 0
+
+    def dump_one_result(self, result):
+        self.dump_results(np.asarray(result, np.float64)[np.newaxis])
+
+    def dump_results(self, results):
+        results = np.asarray(results, np.float64)
+        self._current_paths += len(results)
+        self._running_sum = self._running_sum + np.sum(results, axis=0)
+        self._running_sum_square = self._running_sum_square + np.sum(results * results, axis=0)
+
+    def get_results_so_far(self):
+        means = self._running_sum / self._current_paths
+        variances = (self._running_sum_square / self._current_paths - means * means) * self._current_paths / (self._current_paths - 1)
+        return [list(means), list(np.sqrt(np.maximum(variances, 0) / self._current_paths))]
+
+    def deepcopy(self):
+        return cp.deepcopy(self)
+
+
+ladder_strikes = np.linspace(2, 12, 50)
+ladder = PayOffLadder([PayOffCall(k) for k in ladder_strikes])
+
+np.random.seed(0)
+gatherer = mc_mean_vector()
+engine = ExoticBSEngine(PathDependentAsian(times, expiry, ladder), vol, d, r, GaussianRandomNumberGenerator(dates), spot, backend="numpy")
+engine.do_simulation(gatherer, 20000)
+
+ladder_means, ladder_errors = gatherer.get_results_so_far()
+print(f'{len(ladder_means)} strikes from one simulation, strike {ladder_strikes[10]}: {ladder_means[10]} +/- {ladder_errors[10]}')
+
+# 19. streaming the cash flows of every path
+
+# the gatherer only ever sees one discounted number per path, so exposure
+# profiles or PnL explain would have to simulate again
+# do_simulation(..., sink=CashFlowSink(...)) also streams the undiscounted
+# cash flows of every path - one column per possible cash-flow time, importance
+# weights applied - to a file as it goes
+# sink is keyword-only on every engine, since their positional arguments differ
+# the sink holds at most block_paths rows and writes each full block as one
+# .npy record, so memory stays bounded however many paths are run
+# CashFlowReader gives back the cash-flow times and iterates the blocks as
+# numpy arrays
+
+
+class CashFlowSink:
+    def __init__(self, path, cashflow_times, block_paths=65536, dtype=np.float64):
+        self._file = open(path, "wb")
+        np.save(self._file, np.asarray(cashflow_times, dtype=float))
+        self._block = np.zeros((block_paths, len(cashflow_times)), dtype)
+        self._count = 0
+
+    def write(self, amounts):
+        amounts = np.asarray(amounts).reshape(len(amounts), -1)
+
+        while len(amounts) > 0:
+            take = min(len(self._block) - self._count, len(amounts))
+            self._block[self._count:self._count + take] = amounts[:take]
+            self._count += take
+            amounts = amounts[take:]
+
+            if self._count == len(self._block):
+                self.flush()
+
+    def flush(self):
+        if self._count > 0:
+            np.save(self._file, self._block[:self._count])
+            self._count = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+class CashFlowReader:
+    def __init__(self, path):
+        self._path = path
+
+        with open(path, "rb") as cash_flow_file:
+            self._cashflow_times = np.load(cash_flow_file)
+
+    def get_cashflow_times(self):
+        return self._cashflow_times
+
+    def __iter__(self):
+        with open(self._path, "rb") as cash_flow_file:
+            size = os.fstat(cash_flow_file.fileno()).st_size
+            np.load(cash_flow_file)
+
+            while cash_flow_file.tell() < size:
+                yield np.load(cash_flow_file)
+
+
+cash_flow_path = os.path.join(tempfile.mkdtemp(), "strip.npy")
+
+np.random.seed(0)
+option = PathDependentStrip(times, payoff)
+gatherer = mc_mean()
+engine = ExoticBSEngine(option, vol, d, r, GaussianRandomNumberGenerator(dates), spot, backend="numpy")
+
+sink = CashFlowSink(cash_flow_path, option.possible_cashflow_times(), block_paths=3000)
+engine.do_simulation(gatherer, 10000, sink=sink)
+sink.close()
+
+reader = CashFlowReader(cash_flow_path)
+discounts = np.exp(-r * reader.get_cashflow_times())
+streamed_sum = 0.0
+streamed_paths = 0
+
+for block in reader:
+    streamed_sum += np.sum(block @ discounts)
+    streamed_paths += len(block)
+
+print(f'{streamed_paths} streamed paths, price = {streamed_sum / streamed_paths}, gatherer = {gatherer.get_results_so_far()[0][0]}')
+
+# 20. a time budget - stopping at a deadline instead of a path count
+
+# do_simulation_within(gatherer, seconds) runs do_simulation in batches and
+# reads a monotonic clock between them, so the latency is the budget plus at
+# most one batch - a smaller batch_size tightens it on the slow backends
+# the first batch always runs, max_paths is an optional upper limit, and the
+# call returns [price, std error, paths done] while also feeding the gatherer
+# - for a PayOffLadder price and std error are arrays, one entry per payoff
+
+option = PathDependentAsian(times, expiry, payoff)
+
+for backend, budget in (("python", 0.05), ("numpy", 0.05), ("numpy", 0.5)):
+    np.random.seed(0)
+    engine = ExoticBSEngine(option, vol, d, r, GaussianRandomNumberGenerator(dates), spot, backend=backend)
+    start = time.monotonic()
+    price, std_error, done = engine.do_simulation_within(mc_mean(), budget, batch_size=1024)
+
+    print(f'{backend}, {budget}s budget: price = {price}, std error = {std_error}, paths = {done}, took {time.monotonic() - start:.3f}s')
+
+# 21. comparing estimators - variance times time
+
+# a faster sampler is no use if it is noisier, and a quieter one no use if it
+# is much slower - what matters is variance x time, the work needed to reach a
+# given error
+# benchmark_estimators prices every product with every estimator over a set of
+# seeds and records the mean price, the variance of the price across seeds,
+# the mean wall time and their product
+# an estimator is a sampler (seed -> generator) and whether the control variate
+# is applied; quasi-random and stratified need scipy and are left out without it
+# the records go to a JSON file along with the numpy version, so runs from
+# different releases can be compared
+
+
+class PayOffDoubleDigital(PayOff):
+    def __init__(self, strike):
+        self._lower = strike[0]
+        self._upper = strike[1]
+
+    def get_strike(self):
+        return (self._lower, self._upper)
+
+    def __call__(self, spot):
+        return ((self._lower <= spot) & (spot <= self._upper)).astype(float)
+
+
+estimator_configurations = {
+    "plain": (lambda seed: BufferedGaussianRandomNumberGenerator(1, seed=seed), False),
+    "antithetic": (lambda seed: AntitheticGaussianRandomNumberGenerator(BufferedGaussianRandomNumberGenerator(1, seed=seed)), False),
+    "control variate": (lambda seed: BufferedGaussianRandomNumberGenerator(1, seed=seed), True),
+}
+
+if qmc is not None:
+    estimator_configurations["quasi-random"] = (lambda seed: SobolGaussianRandomNumberGenerator(1, seed=seed), False)
+    estimator_configurations["stratified"] = (lambda seed: StratifiedGaussianRandomNumberGenerator(1, seed=seed), False)
+
+
+def benchmark_estimators(products, configurations, vol, d, r, spot, paths, seeds, output_path):
+    records = []
+
+    for product_name, product in products.items():
+        for estimator_name, (sampler, control) in configurations.items():
+            prices = np.zeros(len(seeds))
+            elapsed = np.zeros(len(seeds))
+
+            for i in range(len(seeds)):
+                engine = ExoticBSEngine(product, vol, d, r, sampler(seeds[i]), spot, backend="numpy")
+                gatherer = mc_mean()
+                start = time.perf_counter()
+
+                if control:
+                    engine.do_simulation_controlled(gatherer, paths)
+                else:
+                    engine.do_simulation(gatherer, paths)
+
+                elapsed[i] = time.perf_counter() - start
+                prices[i] = gatherer.get_results_so_far()[0][0]
+
+            variance = np.var(prices, ddof=1)
+            records.append({"product": product_name, "estimator": estimator_name, "paths": paths,
+                            "seeds": len(seeds), "price": np.mean(prices), "variance": variance,
+                            "time": np.mean(elapsed), "variance_x_time": variance * np.mean(elapsed)})
+
+    with open(output_path, "w") as output:
+        json.dump({"numpy": np.__version__, "records": records}, output, indent=2)
+
+    return records
+
+
+monthly_times = np.arange(1, 13) / 12
+benchmark_products = {
+    "vanilla": PathDependentAsian(monthly_times[-1:], 1.0, PayOffCall(100)),
+    "asian": PathDependentAsian(monthly_times, 1.0, PayOffCall(100)),
+    "double digital": PathDependentAsian(monthly_times[-1:], 1.0, PayOffDoubleDigital((95, 105))),
+}
+benchmark_path = os.path.join(tempfile.mkdtemp(), "estimators.json")
+
+records = benchmark_estimators(benchmark_products, estimator_configurations, 0.2, 0.0, 0.05, 100,
+                               2 ** 14, list(range(20)), benchmark_path)
+
+for record in records:
+    print(f'{record["product"]}, {record["estimator"]}: price = {record["price"]}, variance = {record["variance"]:.3g}, '
+          f'time = {record["time"]:.4f}s, variance x time = {record["variance_x_time"]:.3g}')
+
+# 22. moment matching
+
+# matching the first two moments of every batch removes the noise from the
+# drift and the overall level of the draws - the price still has to be read
+# with a batch-means error, since the naive per-path error ignores that paths
+# inside a batch are tied together
+# the spread over seeds below is the true error of a run
+
+option = PathDependentAsian(monthly_times, 1.0, PayOffCall(100))
+
+for moment_matching in (False, True):
+    prices = []
+
+    for seed in range(20):
+        np.random.seed(seed)
+        gatherer = mc_batch_means(4096)
+        naive = mc_moments(gatherer)
+        engine = ExoticBSEngine(option, 0.2, 0.0, 0.05, GaussianRandomNumberGenerator(12, moment_matching=moment_matching), 100, backend="numpy")
+        engine.do_simulation(naive, 16 * 4096, batch_size=4096)
+        prices.append(gatherer.get_results_so_far()[0][0])
+
+    print(f'moment matching={moment_matching}: price = {np.mean(prices)}, spread over seeds = {np.std(prices, ddof=1)}, '
+          f'batch-means error = {gatherer.get_results_so_far()[0][1]}, naive error = {naive.get_results_so_far()[0][1]}')
@@ -1,7 +1,13 @@
 import numpy as np
 import copy as cp
+import time
 from dataclasses import dataclass
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 class PayOff:
     def __init__(self, strike):
@@ -19,7 +25,7 @@ class PayOffCall(PayOff):
         return self._strike
 
     def __call__(self, spot):
-        return max(self._strike - spot, 0)
+        return np.maximum(self._strike - spot, 0)
 
 
 class PayOffBridge:
@@ -143,7 +149,7 @@ class TreeAmerican(TreeProduct):
         return self._payoff(spot)
 
     def pre_final_value(self, spot, time, discounted_fv):
-        return max(self._payoff(spot), discounted_fv)
+        return np.maximum(self._payoff(spot), discounted_fv)
 
 
 class TreeEuropean(TreeProduct):
@@ -171,9 +177,17 @@ class pair:
     second: float
 
 
+@dataclass
+class TreeGreeks:
+    price: float
+    delta: float
+    gamma: float
+    theta: float
+
+
 class SimpleBinomialTree:
 
-    def __init__(self, spot, r, d, vol, steps, time):
+    def __init__(self, spot, r, d, vol, steps, time, backend="python", truncation=None):
         self._spot = spot
         self._r = Parameters(r)
         self._d = Parameters(d)
@@ -183,6 +197,8 @@ class SimpleBinomialTree:
         self._tree_built = False
         self._tree = []
         self._discounts = [0 for i in range(self._steps)]
+        self._backend = backend
+        self._truncation = truncation
 
     def build_tree(self):
         self._tree_built = True
@@ -194,17 +210,24 @@ class SimpleBinomialTree:
             self._tree[i] = [pair(0, 0) for i in range(i + 1)]
             this_time = i * self._time / self._steps
             moved_log_spot = initial_log_spot + self._r.integral(0, this_time) - self._d.integral(0, this_time)
-            moved_log_spot -= 0.5 * this_time * vol * vol
-            std_dev = vol * np.sqrt(self._time / self._steps)
+            moved_log_spot -= 0.5 * self._vol.integral_square(0, this_time)
+            std_dev = np.sqrt(self._vol.integral_square(0, self._time / self._steps))
 
             k = 0
             for j in range(-i, i + 2, 2):
                 self._tree[i][k].first = np.exp(moved_log_spot + j * std_dev)
+                k += 1
 
         for l in range(self._steps):
             self._discounts[l] = np.exp(-self._r.integral(l * self._time / self._steps, (l + 1) * self._time / self._steps))
 
-    def get_price(self, tree_product):
+    def get_price(self, tree_product, greeks=False):
+        if greeks:
+            return self.get_greeks(tree_product)
+
+        if self._backend != "python" or self._truncation is not None:
+            return self.get_price_sliced(tree_product)
+
         if not self._tree_built:
             self.build_tree()
 
@@ -230,6 +253,90 @@ class SimpleBinomialTree:
 
         return self._tree[0][0].second
 
+    def node_spots(self, index, nodes, offset=0):
+        this_time = (index - offset) * self._time / self._steps
+        moved_log_spot = np.log(self._spot) + self._r.integral(0, this_time) - self._d.integral(0, this_time)
+        moved_log_spot -= 0.5 * self._vol.integral_square(0, this_time)
+        std_dev = np.sqrt(self._vol.integral_square(0, self._time / self._steps))
+
+        return np.exp(moved_log_spot + std_dev * (2 * nodes - index))
+
+    def slice_spots(self, index, offset=0):
+        return self.node_spots(index, np.arange(index + 1), offset)
+
+    def band(self, index):
+        # the nodes of a slice kept by the truncation, as a range of node numbers
+        if self._truncation is None:
+            return 0, index
+
+        width = int(np.ceil(self._truncation * np.sqrt(self._steps)))
+        return max(0, (index - width + 1) // 2), min(index, (index + width) // 2)
+
+    def boundary_values(self, tree_product, index, nodes, offset=0):
+        # just outside the band the spot is too far from the forward to matter,
+        # so the value is the product's rule applied to the discounted payoff
+        # of the deterministic forward
+        this_time = (index - offset) * self._time / self._steps
+        spots = self.node_spots(index, nodes, offset)
+        growth = self._r.integral(this_time, self._time) - self._d.integral(this_time, self._time)
+        discounted = np.exp(-self._r.integral(this_time, self._time)) * tree_product.final_payoff(spots * np.exp(growth))
+
+        return tree_product.pre_final_value(spots, this_time, discounted)
+
+    def roll_back(self, tree_product, offset=0, keep=(0,)):
+        # backward induction over steps + offset slices, the first offset of
+        # them before time zero - returns the values of the slices in keep
+        if tree_product.get_final_time() != self._time:
+            raise ValueError("mismatched product in simple binomial tree!")
+
+        induct = slice_inductions[resolve_backend("numpy" if self._backend == "python" else self._backend)]
+        dt = self._time / self._steps
+        last = self._steps + offset
+        values = np.zeros(last + 1)
+        low, high = self.band(last)
+        values[low:high + 1] = tree_product.final_payoff(self.node_spots(last, np.arange(low, high + 1), offset))
+        kept = {}
+
+        for index in range(last - 1, -1, -1):
+            this_time = (index - offset) * dt
+            discount = np.exp(-self._r.integral(this_time, this_time + dt))
+            next_low, next_high = self.band(index + 1)
+            low, high = self.band(index)
+
+            outside = np.array([k for k in (low, high + 1) if k < next_low or k > next_high], dtype=int)
+            if len(outside) > 0:
+                values[outside] = self.boundary_values(tree_product, index + 1, outside, offset)
+
+            induct(values[low:], high - low + 1, discount)
+            nodes = np.arange(low, high + 1)
+            values[low:high + 1] = tree_product.pre_final_value(self.node_spots(index, nodes, offset), this_time, values[low:high + 1])
+
+            if index in keep:
+                kept[index] = values[:index + 1].copy()
+
+        return kept
+
+    def get_price_sliced(self, tree_product):
+        return self.roll_back(tree_product)[0][0]
+
+    def get_greeks(self, tree_product):
+        # the tree is started two steps before time zero, so today's slice has
+        # three nodes centred on the spot - delta and gamma are read off it and
+        # theta from the same node two steps apart
+        dt = self._time / self._steps
+        kept = self.roll_back(tree_product, offset=2, keep=(0, 2))
+
+        spots = self.slice_spots(2, 2)
+        values = kept[2]
+        root_spot = self.slice_spots(0, 2)[0]
+        root_value = kept[0][0]
+
+        delta = (values[2] - values[0]) / (spots[2] - spots[0])
+        gamma = ((values[2] - values[1]) / (spots[2] - spots[1]) - (values[1] - values[0]) / (spots[1] - spots[0])) / (0.5 * (spots[2] - spots[0]))
+        theta = (values[1] - root_value - delta * (spots[1] - root_spot)) / (2 * dt)
+
+        return TreeGreeks(values[1], delta, gamma, theta)
+
 # putting everything together
 
 
@@ -253,3 +360,271 @@ american_option_price = tree_used.get_price(american_option)
 
 print(f'European option price = {european_option_price}')
 print(f'American option price = {american_option_price}')
+
+# 5. compiled kernels - an optional backend for the backward induction
+
+# the python backend walks every node of every slice through pair objects
+# the sliced backends hold one slice as a flat array and induct it in place,
+# the products see a whole slice of spots at a time
+# backend="numba" compiles the discounted averaging of neighbouring nodes,
+# backend="numpy" is the fallback when numba is not installed
+
+
+def resolve_backend(backend):
+    if backend not in ("python", "numpy", "numba"):
+        raise ValueError(f"unknown backend {backend}!")
+
+    if backend == "numba" and numba is None:
+        return "numpy"
+
+    return backend
+
+
+def induct_slice_numpy(values, nodes, discount):
+    values[:nodes] += values[1:nodes + 1]
+    values[:nodes] *= 0.5 * discount
+
+
+def induct_slice_loop(values, nodes, discount):
+    for k in range(nodes):
+        values[k] = 0.5 * discount * (values[k] + values[k + 1])
+
+
+slice_inductions = {
+    "numpy": induct_slice_numpy,
+    "numba": numba.njit(induct_slice_loop) if numba is not None else induct_slice_numpy,
+}
+
+for backend in ("numpy", "numba"):
+    tree_used = SimpleBinomialTree(spot, r, d, vol, steps, expiry, backend=backend)
+
+    print(f'{backend} backend European option price = {tree_used.get_price(european_option)}')
+    print(f'{backend} backend American option price = {tree_used.get_price(american_option)}')
+
+# 6. a Crank-Nicolson finite-difference engine
+
+# the tree moves one node per step, the PDE grid is free to be much finer in
+# space than in time - and a whole ladder of spots comes out at once
+# the grid is in log-spot, centred on today's spot, width standard deviations
+# either side; time steps are Crank-Nicolson, except the first few, which are
+# split into two fully implicit half-steps (Rannacher start-up) to damp the
+# kink of the payoff
+# each step is a tridiagonal solve (Thomas algorithm)
+# early exercise is a penalty method - nodes where pre_final_value lifts the
+# continuation value are pinned to it with a large penalty and the system is
+# solved again, until the set of exercised nodes stops changing
+# any TreeProduct works as long as final_payoff and pre_final_value accept a
+# whole slice of spots
+# the edges of the grid are rolled back along a single node, discounting only
+
+
+def thomas_loop(lower, diagonal, upper, rhs):
+    n = len(rhs)
+    c = np.zeros(n)
+    x = np.zeros(n)
+
+    c[0] = upper[0] / diagonal[0]
+    x[0] = rhs[0] / diagonal[0]
+
+    for j in range(1, n):
+        denominator = diagonal[j] - lower[j] * c[j - 1]
+        c[j] = upper[j] / denominator
+        x[j] = (rhs[j] - lower[j] * x[j - 1]) / denominator
+
+    for j in range(n - 2, -1, -1):
+        x[j] -= c[j] * x[j + 1]
+
+    return x
+
+
+thomas_solve = numba.njit(thomas_loop) if numba is not None else thomas_loop
+
+
+class FiniteDifferenceEngine:
+
+    def __init__(self, spot, r, d, vol, steps, time, space_steps=400, width=5, rannacher_steps=2, penalty=1e8):
+        self._spot = spot
+        self._r = Parameters(r)
+        self._d = Parameters(d)
+        self._vol = Parameters(vol)
+        self._steps = steps
+        self._time = time
+        self._space_steps = space_steps + space_steps % 2
+        self._rannacher_steps = rannacher_steps
+        self._penalty = penalty
+
+        half_width = width * np.sqrt(self._vol.integral_square(0, time))
+        self._dx = 2 * half_width / self._space_steps
+        self._log_spots = np.log(spot) + np.linspace(-half_width, half_width, self._space_steps + 1)
+        self._spots = np.exp(self._log_spots)
+
+    def get_spots(self):
+        return self._spots
+
+    def theta_step(self, tree_product, values, this_time, dt, theta):
+        r = self._r.integral(this_time, this_time + dt) / dt
+        d = self._d.integral(this_time, this_time + dt) / dt
+        variance = self._vol.integral_square(this_time, this_time + dt) / dt
+        nu = r - d - 0.5 * variance
+
+        a = 0.5 * variance / self._dx ** 2 - 0.5 * nu / self._dx
+        c = 0.5 * variance / self._dx ** 2 + 0.5 * nu / self._dx
+        b = -variance / self._dx ** 2 - r
+
+        # explicit part of the step on the interior nodes
+        rhs = values[1:-1] + (1 - theta) * dt * (a * values[:-2] + b * values[1:-1] + c * values[2:])
+
+        # edges - discounted along a single node, then the product's rule
+        edges = np.exp(-r * dt) * values[[0, -1]]
+        edges = np.asarray(tree_product.pre_final_value(self._spots[[0, -1]], this_time, edges), dtype=float)
+        rhs[0] += theta * dt * a * edges[0]
+        rhs[-1] += theta * dt * c * edges[1]
+
+        interior = len(rhs)
+        lower = np.full(interior, -theta * dt * a)
+        diagonal = np.full(interior, 1 - theta * dt * b)
+        upper = np.full(interior, -theta * dt * c)
+        lower[0] = 0
+        upper[-1] = 0
+
+        continuation = thomas_solve(lower, diagonal, upper, rhs)
+        spots = self._spots[1:-1]
+        active = np.zeros(interior, dtype=bool)
+
+        for iteration in range(50):
+            adjusted = np.asarray(tree_product.pre_final_value(spots, this_time, continuation), dtype=float)
+            now_active = adjusted > continuation
+
+            if not now_active.any() or (now_active == active).all():
+                break
+
+            active = now_active
+            penalties = self._penalty * active
+            continuation = thomas_solve(lower, diagonal + penalties, upper, rhs + penalties * adjusted)
+
+        new_values = np.empty_like(values)
+        new_values[0], new_values[-1] = edges
+        new_values[1:-1] = tree_product.pre_final_value(spots, this_time, continuation)
+        return new_values
+
+    def get_prices(self, tree_product):
+        if tree_product.get_final_time() != self._time:
+            raise ValueError("mismatched product in finite-difference engine!")
+
+        dt = self._time / self._steps
+        values = np.array(tree_product.final_payoff(self._spots), dtype=float)
+
+        for i in range(self._steps - 1, -1, -1):
+            this_time = i * dt
+
+            if self._steps - i <= self._rannacher_steps:
+                values = self.theta_step(tree_product, values, this_time + 0.5 * dt, 0.5 * dt, 1.0)
+                values = self.theta_step(tree_product, values, this_time, 0.5 * dt, 1.0)
+            else:
+                values = self.theta_step(tree_product, values, this_time, dt, 0.5)
+
+        return values
+
+    def get_price(self, tree_product):
+        return np.interp(self._spot, self._spots, self.get_prices(tree_product))
+
+
+fd_engine = FiniteDifferenceEngine(spot, r, d, vol, 200, expiry)
+
+print(f'finite-difference European option price = {fd_engine.get_price(european_option)}')
+print(f'finite-difference American option price = {fd_engine.get_price(american_option)}')
+
+# 7. Greeks from the same backward induction
+
+# bumping the spot and re-pricing costs two to four extra trees per trade
+# get_price(product, greeks=True) starts the tree two steps before time zero
+# instead, so the slice at time zero has three nodes around the spot
+# delta and gamma are finite differences across those nodes and theta compares
+# the middle node with the root, all from the one induction
+
+greeks_tree = SimpleBinomialTree(spot, r, d, vol, steps, expiry, backend="numpy")
+american_greeks = greeks_tree.get_price(american_option, greeks=True)
+
+print(f'American option greeks = {american_greeks}')
+
+# 8. pricing a whole book at once - batched trees
+
+# one SimpleBinomialTree prices one underlying, so a book of thousands of
+# single-name options means thousands of tree objects
+# BatchedBinomialTree takes arrays of spots, rates, dividend yields, vols and
+# expiries with a common number of steps and inducts every tree at once, one
+# (batch x nodes) slice at a time
+# Parameters already broadcast over arrays, and so do the vectorised products -
+# give each row its own strike with a (batch x 1) strike array
+
+
+class BatchedBinomialTree:
+
+    def __init__(self, spots, r, d, vol, steps, times):
+        spots, r, d, vol, times = np.broadcast_arrays(*(np.asarray(x, dtype=float) for x in (spots, r, d, vol, times)))
+        self._spots = spots
+        self._r = Parameters(r)
+        self._d = Parameters(d)
+        self._vol = Parameters(vol)
+        self._steps = steps
+        self._times = times
+        self._dt = times / steps
+
+    def slice_spots(self, index):
+        this_time = index * self._dt
+        moved_log_spots = np.log(self._spots) + self._r.integral(0, this_time) - self._d.integral(0, this_time)
+        moved_log_spots -= 0.5 * self._vol.integral_square(0, this_time)
+        std_dev = np.sqrt(self._vol.integral_square(0, self._dt))
+
+        return np.exp(moved_log_spots[:, np.newaxis] + std_dev[:, np.newaxis] * np.arange(-index, index + 1, 2))
+
+    def get_price(self, tree_product):
+        if not np.allclose(tree_product.get_final_time(), self._times):
+            raise ValueError("mismatched product in batched binomial tree!")
+
+        values = np.array(np.broadcast_to(tree_product.final_payoff(self.slice_spots(self._steps)),
+                                          (len(self._spots), self._steps + 1)), dtype=float)
+
+        for index in range(self._steps - 1, -1, -1):
+            this_time = index * self._dt
+            discount = np.exp(-self._r.integral(this_time, this_time + self._dt))[:, np.newaxis]
+
+            values[:, :index + 1] += values[:, 1:index + 2]
+            values[:, :index + 1] *= 0.5 * discount
+            values[:, :index + 1] = tree_product.pre_final_value(self.slice_spots(index), this_time[:, np.newaxis], values[:, :index + 1])
+
+        return values[:, 0]
+
+
+book_size = 1000
+book_spots = np.linspace(3, 9, book_size)
+book_strikes = np.linspace(5, 8, book_size)
+
+book_tree = BatchedBinomialTree(book_spots, r, d, vol, steps, expiry)
+book_prices = book_tree.get_price(TreeAmerican(expiry, PayOffCall(book_strikes[:, np.newaxis])))
+
+single_tree = SimpleBinomialTree(book_spots[-1], r, d, vol, steps, expiry, backend="numpy")
+single_price = single_tree.get_price(TreeAmerican(expiry, PayOffCall(book_strikes[-1])))
+
+print(f'{book_size} American options priced, last = {book_prices[-1]}, single tree = {single_price}')
+
+# 9. truncating the tree
+
+# at slice i the tree carries i + 1 nodes, but the far tails are many standard
+# deviations from the forward and contribute nothing - the work is O(N^2)
+# truncation=k keeps only the nodes within k standard deviations (of the whole
+# period) of the forward, about 2k sqrt(N) nodes a slice, so the work drops to
+# O(N^1.5); nodes just outside the band take boundary_values
+# error bound - the tree reaches the edge of the band with probability about
+# 2 (1 - N(k)), and the boundary values are out by at most the option's time
+# value there, so the price moves by no more than that product; k = 6 puts it
+# below 1e-8 of the payoff scale
+
+reference_steps = 20000
+
+for truncation in (None, 6):
+    reference_tree = SimpleBinomialTree(spot, r, d, vol, reference_steps, expiry, backend="numba", truncation=truncation)
+    start = time.perf_counter()
+    reference_price = reference_tree.get_price(american_option)
+
+    print(f'{reference_steps} steps, truncation={truncation}: {reference_price} in {time.perf_counter() - start:.2f}s')
@@ -1,6 +1,7 @@
 import numpy as np
 import scipy.stats as stats
 import copy as cp
+import concurrent.futures as futures
 
 # 1. introduction
 
@@ -23,8 +24,8 @@ class BSCall:
     
     def __call__(self, vol):
 
-        d1 = (np.log(self._spot / self._strike) + (self._r + 0.5 * vol ** 2) * self._T) / (vol * np.sqrt(self._T))
-        d2 = (np.log(self._spot / self._strike) + (self._r - 0.5 * vol ** 2) * self._T) / (vol * np.sqrt(self._T))
+        d1 = (np.log(self._spot / self._strike) + (self._r - self._d + 0.5 * vol ** 2) * self._T) / (vol * np.sqrt(self._T))
+        d2 = (np.log(self._spot / self._strike) + (self._r - self._d - 0.5 * vol ** 2) * self._T) / (vol * np.sqrt(self._T))
 
         return (self._spot * np.exp(-self._d * self._T) * stats.norm.cdf(d1, 0, 1) - 
                 self._strike * np.exp(-self._r * self._T) * stats.norm.cdf(d2, 0, 1))
@@ -84,12 +85,185 @@ class BSCallv2(BSCall):
         self._strike = strike
     
     def vega(self, vol):
-        d1 = (np.log(self._spot / self._strike) + (self._r + 0.5 * vol ** 2) * self._T) / (vol * np.sqrt(self._T))
+        d1 = (np.log(self._spot / self._strike) + (self._r - self._d + 0.5 * vol ** 2) * self._T) / (vol * np.sqrt(self._T))
 
-        return self._spot * np.exp(-0.5 * d1 ** 2) * np.sqrt(self._T) / np.sqrt(2 * np.pi)
+        return self._spot * np.exp(-self._d * self._T) * np.exp(-0.5 * d1 ** 2) * np.sqrt(self._T) / np.sqrt(2 * np.pi)
 
 # 5. using Newton-Raphson to do implied volatilities
 
 black_scholes_call = BSCallv2(0.1, 0.01, 100, 50, 10)
 
 NewtonRaphson(black_scholes_call(5), 0.5, 1e-20, black_scholes_call, black_scholes_call.vega)
+
+# 6. implied-volatility surfaces
+
+## a surface is one inversion per quote, rebuilt every few seconds from the
+## option chain
+## quotes are grouped by expiry and every expiry slice is solved on its own -
+## in parallel when an executor (e.g. a ProcessPoolExecutor kept alive between
+## rebuilds) is supplied
+## within a slice strikes are solved in order and each Newton-Raphson starts
+## from its neighbour's volatility, so it converges in a step or two
+## Newton-Raphson is capped and falls back to bisection when it runs out of
+## (low, high); prices outside the no-arbitrage bounds give nan
+## the result is a grid of expiries x strikes holding total variance vol^2 T,
+## interpolated bilinearly - linear in total variance along expiry keeps the
+## surface free of calendar arbitrage between the grid lines
+## an expiry with no usable quote is left off the grid (get_dropped_expiries),
+## and a grid with a single expiry or strike is flat along that axis
+
+
+def safeguarded_newton(target, start, low, high, tolerance, value, derivative, max_iterations=20):
+    x = start
+    y = value(x)
+    iterations = 0
+
+    while abs(y - target) > tolerance:
+        d = derivative(x)
+        iterations += 1
+
+        if d <= 0 or iterations > max_iterations:
+            return bisection(target, low, high, tolerance, value)
+
+        x += (target - y) / d
+
+        if not low < x < high:
+            return bisection(target, low, high, tolerance, value)
+
+        y = value(x)
+
+    return x
+
+
+def solve_expiry_slice(r, d, T, spot, strikes, prices, start=0.2, low=1e-4, high=5.0, tolerance=1e-10):
+    vols = np.full(len(strikes), np.nan)
+    guess = start
+
+    for i in range(len(strikes)):
+        black_scholes_call = BSCallv2(r, d, T, spot, strikes[i])
+        lower_bound = max(spot * np.exp(-d * T) - strikes[i] * np.exp(-r * T), 0)
+
+        if not lower_bound < prices[i] < spot * np.exp(-d * T):
+            continue
+
+        if not black_scholes_call(low) < prices[i] < black_scholes_call(high):
+            continue
+
+        vols[i] = safeguarded_newton(prices[i], guess, low, high, tolerance, black_scholes_call, black_scholes_call.vega)
+        guess = vols[i]
+
+    return vols
+
+
+def solve_expiry_task(task):
+    return solve_expiry_slice(*task)
+
+
+def locate(axis, x):
+    ## the grid line below x, the one above and the weight on the one above
+    if len(axis) == 1:
+        return 0, 0, np.zeros_like(x)
+
+    i = np.clip(np.searchsorted(axis, x) - 1, 0, len(axis) - 2)
+    return i, i + 1, (x - axis[i]) / (axis[i + 1] - axis[i])
+
+
+class VolSurface:
+
+    def __init__(self, expiries, strikes, vols, dropped_expiries=()):
+        self._expiries = np.asarray(expiries, dtype=float)
+        self._strikes = np.asarray(strikes, dtype=float)
+        self._total_variance = np.asarray(vols, dtype=float) ** 2 * self._expiries[:, np.newaxis]
+        self._dropped_expiries = list(dropped_expiries)
+
+    def get_expiries(self):
+        return self._expiries
+
+    def get_strikes(self):
+        return self._strikes
+
+    def get_dropped_expiries(self):
+        return self._dropped_expiries
+
+    def total_variance(self, expiry, strike):
+        expiry = np.clip(expiry, self._expiries[0], self._expiries[-1])
+        strike = np.clip(strike, self._strikes[0], self._strikes[-1])
+
+        i, k, u = locate(self._expiries, expiry)
+        j, l, v = locate(self._strikes, strike)
+
+        return ((1 - u) * (1 - v) * self._total_variance[i, j] + (1 - u) * v * self._total_variance[i, l] +
+                u * (1 - v) * self._total_variance[k, j] + u * v * self._total_variance[k, l])
+
+    def __call__(self, expiry, strike):
+        return np.sqrt(self.total_variance(expiry, strike) / np.clip(expiry, self._expiries[0], self._expiries[-1]))
+
+
+def build_vol_surface(quotes, spot, r, d, executor=None):
+    ## quotes are (expiry, strike, call price) triples
+    slices = {}
+    for expiry, strike, price in quotes:
+        slices.setdefault(expiry, []).append((strike, price))
+
+    expiries = sorted(slices.keys())
+    tasks = []
+    for expiry in expiries:
+        strikes, prices = zip(*sorted(slices[expiry]))
+        tasks.append((r, d, expiry, spot, np.array(strikes), np.array(prices)))
+
+    if executor is None:
+        solved = [solve_expiry_task(task) for task in tasks]
+    else:
+        solved = list(executor.map(solve_expiry_task, tasks))
+
+    ## every expiry with at least one usable quote is put onto the union of
+    ## the quoted strikes
+    usable = [i for i in range(len(expiries)) if np.any(~np.isnan(solved[i]))]
+    dropped = [expiries[i] for i in range(len(expiries)) if i not in usable]
+
+    if len(usable) == 0:
+        raise ValueError("no quote in the chain gives an implied volatility!")
+
+    grid_strikes = np.unique(np.concatenate([task[4] for task in tasks]))
+    grid_vols = np.zeros((len(usable), len(grid_strikes)))
+
+    for row, i in enumerate(usable):
+        good = ~np.isnan(solved[i])
+        grid_vols[row] = np.interp(grid_strikes, tasks[i][4][good], solved[i][good])
+
+    return VolSurface([expiries[i] for i in usable], grid_strikes, grid_vols, dropped)
+
+
+## a smile of known shape with a dividend yield, priced independently of
+## BSCall - Black's formula on the forward - and then inverted back
+
+def black_forward_call(r, d, T, spot, strike, vol):
+    forward = spot * np.exp((r - d) * T)
+    d1 = np.log(forward / strike) / (vol * np.sqrt(T)) + 0.5 * vol * np.sqrt(T)
+    return np.exp(-r * T) * (forward * stats.norm.cdf(d1) - strike * stats.norm.cdf(d1 - vol * np.sqrt(T)))
+
+chain_spot = 100
+chain_dividend = 0.03
+chain_quotes = []
+for expiry in (0.25, 0.5, 1.0, 2.0):
+    for strike in range(60, 141, 5):
+        smile_vol = 0.2 + 0.1 * np.log(strike / chain_spot) ** 2
+        chain_quotes.append((expiry, strike, black_forward_call(0.05, chain_dividend, expiry, chain_spot, strike, smile_vol)))
+
+## worker processes may re-import this file (the spawn start method), so the
+## pool is only created when it runs as a script
+
+if __name__ == "__main__":
+    with futures.ProcessPoolExecutor(max_workers=2) as executor:
+        surface = build_vol_surface(chain_quotes, chain_spot, 0.05, chain_dividend, executor)
+
+    print(f'implied vol at (1.0, 120) = {surface(1.0, 120)}, smile = {0.2 + 0.1 * np.log(1.2) ** 2}')
+    print(f'at the money: {[float(surface(expiry, 100)) for expiry in (0.5, 1.0, 2.0)]}, smile = 0.2')
+
+## an expiry whose quotes are all below intrinsic is dropped, not fatal, and a
+## single remaining expiry gives a surface flat in expiry
+
+bad_quotes = [quote for quote in chain_quotes if quote[0] == 1.0] + [(3.0, 100, 0.0), (3.0, 110, 0.0)]
+surface = build_vol_surface(bad_quotes, chain_spot, 0.05, chain_dividend)
+
+print(f'dropped expiries = {surface.get_dropped_expiries()}, implied vol at (0.5, 120) = {surface(0.5, 120)}')